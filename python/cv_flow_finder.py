@@ -18,16 +18,147 @@
 #
 
 from itertools import izip
+import math
 import random
 
-import cv2
-
-import numpy
-
 from cv_gst_util import *
+import flow_trace
 
 FLANN_INDEX_KDTREE = 1  # bug: flann enums are missing
 
+# Algorithms to chose from, as used in the "algorithm" property of the
+# elements
+LUCAS_KANADE = 1
+SURF = 2
+PHASE_CORRELATION = 3
+
+# flow sent instead of point correspondences for the first frame after a scene
+# cut: there is no relation between that frame and the previous one.
+SCENE_CUT = 'scene-cut'
+
+def is_scene_cut(flow):
+    return isinstance(flow, str) and flow == SCENE_CUT
+
+class FlowRecord(object):
+    """
+    What the finder sends instead of the flow when it finds the transform
+    itself: the homography (None if none was found), how many points of the
+    flow agree with it, and which proportion of the points they are. The flow
+    itself and which of its points agree with the homography are only there
+    if they were asked for.
+    """
+    def __init__(self, transform, inlier_count, confidence, points=None,
+                 inliers=None, *args, **kw):
+        super(FlowRecord, self).__init__(*args, **kw)
+        self.transform = transform
+        self.inlier_count = inlier_count
+        self.confidence = confidence
+        self.points = points
+        self.inliers = inliers
+
+    def __getstate__(self):
+        # plain floats pickle much smaller than a numpy array
+        transform = None
+        if self.transform is not None:
+            transform = tuple(float(x) for x in self.transform.flat)
+        return (transform, self.inlier_count, self.confidence, self.points,
+                self.inliers)
+
+    def __setstate__(self, state):
+        transform, self.inlier_count, self.confidence, self.points, \
+                self.inliers = state
+        self.transform = None
+        if transform is not None:
+            self.transform = numpy.asarray(transform).reshape((3, 3))
+
+def flow_record(flow, transform, inliers, include_points=False):
+    """
+    Returns a FlowRecord for transform, found from flow, with inliers as
+    returned by transform_from_flow().
+    """
+    count = len(flow[0])
+    if transform is None:
+        inlier_count = 0
+    elif inliers is None:
+        inlier_count = count
+    else:
+        inlier_count = int(inliers.sum())
+    confidence = 0.
+    if count:
+        confidence = inlier_count / float(count)
+    if include_points:
+        return FlowRecord(transform, inlier_count, confidence, flow, inliers)
+    return FlowRecord(transform, inlier_count, confidence)
+
+def flow_points(flow):
+    """
+    Returns the (points0, points1) pair of flow, which can be a FlowRecord, or
+    None if it does not have them.
+    """
+    if isinstance(flow, FlowRecord):
+        return flow.points
+    return flow
+
+def transform_from_flow(flow, threshold=3):
+    """
+    Returns the homography that best describes the flow, found with RANSAC,
+    and a boolean array telling which points of the flow agree with it (None
+    if no homography was found).
+    If flow is a FlowRecord, the homography was already found by the finder.
+    """
+    if isinstance(flow, FlowRecord):
+        return flow.transform, flow.inliers
+    points0, points1 = flow
+    if len(points0) < 4:
+        # not enough for a homography
+        return None, None
+    # Ransac and its threshold allow us to easily weed out outliers.
+    transform, mask = cv2.findHomography(points0, points1,
+                                         method=cv2.RANSAC,
+                                         ransacReprojThreshold=threshold)
+    if mask is None:
+        return transform, None
+    return transform, mask.ravel() != 0
+
+def corner_flow(shape, transform):
+    # the flow of the corners of a frame of the given shape through transform,
+    # which is enough for findHomography to find transform again
+    height, width = shape[:2]
+    corners0 = numpy.asarray([[0., 0.], [width, 0.],
+                              [width, height], [0., height]],
+                             dtype=numpy.float32)
+    extended = numpy.ones((4, 3))
+    extended[:, :2] = corners0
+    warped = transform.dot(extended.transpose()).transpose()
+    corners1 = numpy.float32(warped[:, :2] / warped[:, 2:])
+    return (corners0, corners1)
+
+def grid_flow(shape, transform, steps=8):
+    # the flow through transform of a steps x steps grid of points over a
+    # frame of the given shape. Unlike the corners, these still describe
+    # transform over the whole frame once undistorted.
+    height, width = shape[:2]
+    xs, ys = numpy.meshgrid(numpy.linspace(0., width, steps),
+                            numpy.linspace(0., height, steps))
+    points0 = numpy.float32(numpy.dstack((xs, ys)).reshape(-1, 2))
+    points1 = cv2.perspectiveTransform(points0.reshape(-1, 1, 2),
+                                       numpy.asarray(transform,
+                                                     dtype=numpy.float64))
+    return (points0, points1.reshape(-1, 2))
+
+def _corner_responses(img, points):
+    """
+    Returns the minimal eigenvalue of the gradient covariance matrix at each of
+    the integer points of img, as used by goodFeaturesToTrack to rank corners.
+    It is only computed in the 5x5 neighbourhood each of them depends on.
+    """
+    responses = numpy.zeros(len(points), dtype=numpy.float32)
+    for i, (x, y) in enumerate(numpy.int32(numpy.round(points))):
+        top, left = max(0, y - 2), max(0, x - 2)
+        eigen = cv2.cornerMinEigenVal(img[top:y + 3, left:x + 3], 3)
+        responses[i] = eigen[y - top, x - left]
+    return responses
+
 class Finder(object):
     def __init__(self, *args, **kw):
         super(Finder, self).__init__(*args, **kw)
@@ -49,7 +180,34 @@ class Finder(object):
     def warp_blob(self, blob, transform_matrix):
         raise NotImplementedError()
 
+    def drop_outliers(self, blob, inliers):
+        """
+        Returns blob without the features that were found to be outliers (e.g.
+        on objects moving in front of the camera), so that they are not used
+        again with the next frame. inliers is a boolean array with a value for
+        each point of the flow returned with blob.
+        """
+        return blob
+
+    def close(self):
+        """
+        Releases what the finder keeps between frames that would not be
+        garbage collected, such as threads. Called when it is not used
+        anymore.
+        """
+        pass
+
 class LucasKanadeFinder(Finder):
+    # How to guess where corners went before refining with Lucas-Kanade. With
+    # a good guess, fewer pyramid levels, a smaller window and fewer
+    # iterations are needed.
+    PRIOR_NONE = 0
+    # move the corners by the median displacement of the previous frame
+    PRIOR_EXTRAPOLATE = 1
+    # move the corners through the transform found by a coarse phase
+    # correlation
+    PRIOR_CORRELATION = 2
+
     def __init__(self, corner_count=50,
                        corner_quality_level=0.1,
                        corner_min_distance=50,
@@ -57,6 +215,11 @@ class LucasKanadeFinder(Finder):
                        pyramid_level=4,
                        max_iterations=50,
                        epsilon=0.001,
+                       tile_rows=1,
+                       tile_columns=1,
+                       detection_threads=0,
+                       motion_prior=PRIOR_NONE,
+                       prior_downscale=4,
                        *args, **kw):
 
         super(LucasKanadeFinder, self).__init__(*args, **kw)
@@ -68,8 +231,26 @@ class LucasKanadeFinder(Finder):
         self.pyramid_level = pyramid_level
         self.max_iterations = max_iterations
         self.epsilon = epsilon
+        # Detection can be split in a grid of tiles, each getting its share of
+        # corner_count, so that corners are spread over the whole frame. The
+        # tiles are processed in a pool of detection_threads threads (one per
+        # tile if 0).
+        self.tile_rows = max(1, tile_rows)
+        self.tile_columns = max(1, tile_columns)
+        self.detection_threads = detection_threads
+
+        self.motion_prior = motion_prior
+        self.prior_downscale = prior_downscale
 
         self.mask = None
+        self._pool = None
+        # median displacement of the corners in the last frame
+        self._last_shift = None
+        self._correlator = None
+        # last img1 given to the correlator and its blob, to reuse it when
+        # it is the next img0
+        self._correlator_img = None
+        self._correlator_blob = None
 
     def optical_flow_img(self, img0, img1, blob_buf0=None):
         # for us, blob_buf0 is in the format:
@@ -80,17 +261,30 @@ class LucasKanadeFinder(Finder):
         if blob_buf0 is not None and len(blob_buf0) > self.corner_count / 2:
             corners0 = blob_buf0
         else:
-            corners0 = self._features(img0)
+            with flow_trace.span('detection'):
+                corners0 = self._features(img0)
 
         n_features = len(corners0)
-
-        corners1, status, errors = cv2.calcOpticalFlowPyrLK(
-                    img0, img1, corners0, None,
-                    winSize=(self.win_size,) * 2,
-                    maxLevel=self.pyramid_level,
-                    criteria=(cv2.TERM_CRITERIA_MAX_ITER | cv2.TERM_CRITERIA_EPS,
-                              self.max_iterations, self.epsilon)
-                    )
+        if not n_features:
+            print "no features found"
+            return ((corners0, corners0), corners0)
+
+        with flow_trace.span('prior'):
+            predicted = self._predict(img0, img1, corners0)
+        if predicted is not None:
+            flags = cv2.OPTFLOW_USE_INITIAL_FLOW
+        else:
+            flags = 0
+
+        with flow_trace.span('lk'):
+            corners1, status, errors = cv2.calcOpticalFlowPyrLK(
+                        img0, img1, corners0, predicted,
+                        winSize=(self.win_size,) * 2,
+                        maxLevel=self.pyramid_level,
+                        criteria=(cv2.TERM_CRITERIA_MAX_ITER | cv2.TERM_CRITERIA_EPS,
+                                  self.max_iterations, self.epsilon),
+                        flags=flags
+                        )
 
         # these are a few workarounds because openCV return things in a format
         # slightly different from what we want.
@@ -107,6 +301,8 @@ class LucasKanadeFinder(Finder):
         corners1 = corners1[status]
 
         errors = errors[status]
+        if len(corners0):
+            self._last_shift = numpy.median(corners1 - corners0, axis=0)
         print "%d features found, %d matched"  % (n_features, len(corners0)), ';',
         if len(errors):
             print "errors min/max/avg:", (min(errors),
@@ -115,6 +311,51 @@ class LucasKanadeFinder(Finder):
 
         return ((corners0, corners1), corners1)
 
+    def drop_outliers(self, blob, inliers):
+        # our blob is the end points of the flow
+        if blob is None or inliers is None or len(blob) != len(inliers):
+            return blob
+        dropped = len(blob) - inliers.sum()
+        if dropped:
+            print "dropping %d outliers from tracked corners" % dropped
+        return blob[inliers]
+
+    def close(self):
+        # the threads of a pool keep a reference to it, it is never collected
+        # unless closed
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _predict(self, img0, img1, corners0):
+        # returns where we expect corners0 to be in img1, or None if we have
+        # no idea
+        if self.motion_prior == self.PRIOR_EXTRAPOLATE:
+            if self._last_shift is None:
+                return None
+            return numpy.float32(corners0 + self._last_shift)
+        elif self.motion_prior == self.PRIOR_CORRELATION:
+            if self._correlator is None:
+                self._correlator = PhaseCorrelationFinder(self.prior_downscale)
+            blob0 = None
+            if img0 is self._correlator_img:
+                blob0 = self._correlator_blob
+            transform, blob1 = self._correlator.find_transform(img0, img1,
+                                                               blob0)
+            self._correlator_img = img1
+            self._correlator_blob = blob1
+
+            extended = numpy.ones((len(corners0), 3))
+            extended[:, :2] = corners0.reshape(-1, 2)
+            predicted = transform.dot(extended.transpose()).transpose()
+            predicted = predicted[:, :2] / predicted[:, 2:]
+            # calcOpticalFlowPyrLK writes its result in there, it needs to be
+            # C contiguous
+            return numpy.ascontiguousarray(predicted,
+                                           dtype=numpy.float32).reshape(corners0.shape)
+        return None
+
     def warp_blob(self, blob, transform_matrix):
         if transform_matrix.dtype != numpy.float32:
             new_transform = numpy.ndarray(transform_matrix.shape,
@@ -130,20 +371,78 @@ class LucasKanadeFinder(Finder):
         return warped_blob.transpose()[...,:2]
 
     def _features(self, img):
-        features = cv2.goodFeaturesToTrack(img,
-                                           self.corner_count,
-                                           self.corner_quality_level,
-                                           self.corner_min_distance,
-                                           mask=self.mask)
+        if self.tile_rows * self.tile_columns > 1:
+            features = self._tiled_features(img)
+        else:
+            features = cv2.goodFeaturesToTrack(img,
+                                               self.corner_count,
+                                               self.corner_quality_level,
+                                               self.corner_min_distance,
+                                               mask=self.mask)
+            if features is None:
+                # nothing to track, e.g. a uniform frame
+                features = numpy.zeros((0, 2), dtype=numpy.float32)
         if len(features.shape) == 3:
             assert(features.shape[1:] == (1,2))
             features.shape = (features.shape[0],2)
 
-        cv2.cornerSubPix(img, features, (10, 10), (-1, -1),
-                         (cv2.TERM_CRITERIA_MAX_ITER | cv2.TERM_CRITERIA_EPS,
-                         20, 0.03))
+        if len(features):
+            cv2.cornerSubPix(img, features, (10, 10), (-1, -1),
+                             (cv2.TERM_CRITERIA_MAX_ITER | cv2.TERM_CRITERIA_EPS,
+                             20, 0.03))
         return features
 
+    def _tiled_features(self, img):
+        height, width = img.shape[:2]
+        tiles = []
+        for row in xrange(self.tile_rows):
+            for column in xrange(self.tile_columns):
+                tiles.append((row * height / self.tile_rows,
+                              (row + 1) * height / self.tile_rows,
+                              column * width / self.tile_columns,
+                              (column + 1) * width / self.tile_columns))
+        quota = int(math.ceil(self.corner_count / float(len(tiles))))
+
+        def detect((top, bottom, left, right)):
+            mask = None
+            if self.mask is not None:
+                mask = self.mask[top:bottom, left:right]
+            # goodFeaturesToTrack releases the GIL, so tiles are really
+            # processed in parallel
+            features = cv2.goodFeaturesToTrack(img[top:bottom, left:right],
+                                               quota,
+                                               self.corner_quality_level,
+                                               self.corner_min_distance,
+                                               mask=mask)
+            if features is None:
+                # e.g. a uniform or masked out tile
+                return (numpy.zeros((0, 2), dtype=numpy.float32),
+                        numpy.zeros(0, dtype=numpy.float32))
+            features = features.reshape(-1, 2)
+            features += (left, top)
+            return features, _corner_responses(img, features)
+
+        if self._pool is None:
+            from multiprocessing.pool import ThreadPool
+            self._pool = ThreadPool(self.detection_threads or len(tiles))
+        tile_features = self._pool.map(detect, tiles)
+
+        # the minimum distance is only enforced inside each tile, corners
+        # close to a border can be too close to those of the next tile. Like
+        # goodFeaturesToTrack, we keep the strongest corners first.
+        features = numpy.concatenate([f for f, _ in tile_features])
+        responses = numpy.concatenate([r for _, r in tile_features])
+        order = numpy.argsort(-responses, kind='mergesort')
+        kept = []
+        min_distance_2 = self.corner_min_distance ** 2
+        for point in features[order]:
+            if kept:
+                distances_2 = ((numpy.asarray(kept) - point) ** 2).sum(axis=1)
+                if distances_2.min() < min_distance_2:
+                    continue
+            kept.append(point)
+        return numpy.asarray(kept, dtype=numpy.float32).reshape(-1, 2)
+
 class FrameSURFInfo(object):
     def __init__(self, keypoints, descriptors, flann, *args, **kw):
         super(FrameSURFInfo, self).__init__(*args, **kw)
@@ -152,9 +451,21 @@ class FrameSURFInfo(object):
         self.flann = flann
 
 class SURFFinder(Finder):
-    def __init__(self, *args, **kw):
+    # Below that many matches, a guided matching is considered to have failed
+    # and a global search is done instead.
+    MIN_GUIDED_MATCHES = 8
+
+    def __init__(self, guided_matching=False, search_radius=30, *args, **kw):
         super(SURFFinder, self).__init__(*args, **kw)
         self._surf = cv2.SURF(1000, _extended=True)
+        # When guided, the keypoints of img0 are expected to move through the
+        # transform found for the previous frame, and are only compared with
+        # the keypoints of img1 less than search_radius pixels away from where
+        # they are expected, instead of with all of them.
+        self.guided_matching = guided_matching
+        self.search_radius = search_radius
+        # transform between the last two frames, from their matches
+        self._last_transform = None
 
     def get_surf(self, img):
         # returns  (keypoints, descriptors) where:
@@ -162,7 +473,8 @@ class SURFFinder(Finder):
         # - descriptor is a numpy.ndarray such that descriptors[i] is a
         # 128-float array which is the SURF descriptor of keypoints[i]
 
-        keypoints, descriptors = self._surf.detect(img, None, False)
+        with flow_trace.span('detection'):
+            keypoints, descriptors = self._surf.detect(img, None, False)
 
         # descriptors might not be provided in the right shape, but it should
         # have the right number of elements to be converted.
@@ -185,12 +497,36 @@ class SURFFinder(Finder):
         keypoints0 = surf_to_normal_point_array(surf_keypoints0)
         keypoints1 = surf_to_normal_point_array(surf_keypoints1)
 
+        if self.guided_matching:
+            self._last_transform = None
+            if len(keypoints0) >= 4:
+                with flow_trace.span('ransac'):
+                    self._last_transform, _ = transform_from_flow((keypoints0,
+                                                                   keypoints1))
 
         return (keypoints0, keypoints1), new_blob
 
     def warp_blob(self, blob, transform_matrix):
-        # FIXME: actually implement this
-        return None
+        # The reference becomes the transformed frame, so its keypoints are
+        # those of the frame sent through the inverse of the transform. The
+        # descriptors, and the FLANN index built on them if any, are kept as
+        # they are: they barely change with the small transforms we correct.
+        # Keypoint angles are not updated either, _filter_diverging_angles
+        # only cares about how they differ from the median.
+        if blob is None:
+            return None
+        invert_transform = numpy.linalg.inv(numpy.asarray(transform_matrix,
+                                                          dtype=numpy.float64))
+        points = numpy.ones((len(blob.keypoints), 3))
+        points[:, :2] = [keypoint.pt for keypoint in blob.keypoints]
+        warped = invert_transform.dot(points.transpose()).transpose()
+        warped = warped[:, :2] / warped[:, 2:]
+
+        keypoints = [cv2.KeyPoint(x, y, keypoint.size, keypoint.angle,
+                                  keypoint.response, keypoint.octave,
+                                  keypoint.class_id)
+                     for (x, y), keypoint in izip(warped, blob.keypoints)]
+        return FrameSURFInfo(keypoints, blob.descriptors, blob.flann)
 
     def matching_surf_keypoints(self, img0, img1, blob0):
         # return a pair of list of SURF keypoints that are supposed to match
@@ -209,7 +545,23 @@ class SURFFinder(Finder):
         keypoints1, descriptors1 = self.get_surf(img1)
         print "img1: found %d points" % len(keypoints1)
 
-        indices, dists, flann1 = self._find_neighbours(descriptors0, descriptors1, flann0)
+        indices = None
+        if self.guided_matching and self._last_transform is not None:
+            with flow_trace.span('guided matching'):
+                indices, dists = self._find_neighbours_near(keypoints0,
+                                                            descriptors0,
+                                                            keypoints1,
+                                                            descriptors1)
+            print "guided matching: %d matches" % len(indices)
+            if len(indices) < self.MIN_GUIDED_MATCHES:
+                # the motion changed too much, we fall back to a global search
+                indices = None
+            # the next frame will be matched the same way, no need for a
+            # FLANN index
+            flann1 = None
+        if indices is None:
+            with flow_trace.span('matching'):
+                indices, dists, flann1 = self._find_neighbours(descriptors0, descriptors1, flann0)
 
         (result_keypoints0, result_keypoints1) = ([], [])
         for idx0, idx1 in indices:
@@ -285,6 +637,366 @@ class SURFFinder(Finder):
                 result_dists.append(small_dist)
         return result, result_dists, flann1
 
+    def _find_neighbours_near(self, keypoints0, descriptors0,
+                              keypoints1, descriptors1):
+        # same as _find_neighbours, but only comparing each descriptor of
+        # descriptors0 with those of descriptors1 whose keypoint is close to
+        # where the last transform would move its keypoint.
+        # keypoints1 are put in a grid of search_radius sized cells, so that
+        # the candidates are found in the 3x3 cells around the predicted
+        # position.
+        radius = float(self.search_radius)
+        if not len(keypoints0) or not len(keypoints1):
+            return [], []
+
+        points0 = numpy.ones((len(keypoints0), 3))
+        points0[:, :2] = [keypoint.pt for keypoint in keypoints0]
+        predicted = numpy.asarray(self._last_transform,
+                                  dtype=numpy.float64).dot(points0.transpose())
+        predicted = (predicted[:2] / predicted[2:]).transpose()
+        points1 = numpy.asarray([keypoint.pt for keypoint in keypoints1])
+
+        cells1 = {}
+        for idx1, cell in enumerate(numpy.int32(numpy.floor(points1 / radius))):
+            cells1.setdefault(tuple(cell), []).append(idx1)
+        cells0 = {}
+        for idx0, cell in enumerate(numpy.int32(numpy.floor(predicted / radius))):
+            cells0.setdefault(tuple(cell), []).append(idx0)
+
+        squared_norms1 = (descriptors1 ** 2).sum(axis=1)
+
+        result = []
+        result_dists = []
+        for (x, y), needles in cells0.iteritems():
+            candidates = []
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    candidates.extend(cells1.get((x + dx, y + dy), ()))
+            if not candidates:
+                continue
+            needles = numpy.asarray(needles)
+            candidates = numpy.asarray(candidates)
+
+            # squared distances, like those given by FLANN
+            dists = (descriptors0[needles] ** 2).sum(axis=1)[:, numpy.newaxis] \
+                    + squared_norms1[candidates] \
+                    - 2 * descriptors0[needles].dot(descriptors1[candidates].transpose())
+            offsets = predicted[needles][:, numpy.newaxis] - points1[candidates]
+            near = (offsets ** 2).sum(axis=-1) <= radius ** 2
+
+            # the match has to be near, and much better than any other
+            # candidate of the surrounding cells, near or not
+            order = numpy.argsort(dists, axis=1)
+            for row, idx0 in enumerate(needles):
+                best = order[row, 0]
+                if not near[row, best]:
+                    continue
+                small_dist = dists[row, best]
+                if len(candidates) > 1 \
+                   and not small_dist < dists[row, order[row, 1]] * 0.6:
+                    continue
+                result.append((idx0, candidates[best]))
+                result_dists.append(small_dist)
+        return result, result_dists
+
+
+class FramePhaseInfo(object):
+    def __init__(self, spectrum, log_polar_spectrum=None, *args, **kw):
+        super(FramePhaseInfo, self).__init__(*args, **kw)
+        self.spectrum = spectrum
+        self.log_polar_spectrum = log_polar_spectrum
+
+class PhaseCorrelationFinder(Finder):
+    """
+    Estimates the global motion between two frames with FFT phase correlation
+    instead of tracking features. Only a translation is found, unless
+    log_polar is set, in which case rotation and scale are estimated first by
+    phase correlating the log-polar resampled magnitude spectra.
+
+    The flow returned is made of the four corners of the frame and where the
+    estimated transform sends them, so that consumers can use it exactly like
+    the flow of the other finders.
+    """
+    def __init__(self, downscale=1, log_polar=False, *args, **kw):
+        super(PhaseCorrelationFinder, self).__init__(*args, **kw)
+        self.downscale = max(1, downscale)
+        self.log_polar = log_polar
+
+        # these only depend on the frame size, we compute them once
+        self._window = None
+        self._log_polar_maps = None
+        self._high_pass = None
+
+    def optical_flow_img(self, img0, img1, blob0=None):
+        # blob0 is a FramePhaseInfo
+        transform, blob1 = self.find_transform(img0, img1, blob0)
+        return corner_flow(img0.shape, transform), blob1
+
+    def find_transform(self, img0, img1, blob0=None):
+        """
+        Returns the transform from img0 to img1 at full resolution, and the
+        blob for img1.
+        """
+        with flow_trace.span('fft'):
+            small1 = self._prepare(img1)
+            blob1 = FramePhaseInfo(numpy.fft.fft2(small1 * self._window))
+            if blob0 is None:
+                small0 = self._prepare(img0)
+                blob0 = FramePhaseInfo(numpy.fft.fft2(small0 * self._window))
+
+        if self.log_polar:
+            with flow_trace.span('log-polar'):
+                angle, scale, transform, spectrum1 = \
+                        self._remove_rotation(img0, small1, blob0, blob1)
+        else:
+            angle, scale = 0., 1.
+            transform = numpy.eye(3)
+            spectrum1 = blob1.spectrum
+
+        with flow_trace.span('correlation'):
+            (dx, dy), response = self._phase_correlate(blob0.spectrum,
+                                                       spectrum1)
+        # the shift was measured on the un-rotated frame
+        shift = transform[:2, :2].dot((dx, dy))
+        transform[:2, 2] += shift
+
+        print "phase correlation: shift (%.2f, %.2f), angle %.2f, scale %.3f, response %.3f" \
+                % (shift[0] * self.downscale, shift[1] * self.downscale,
+                   math.degrees(angle), scale, response)
+
+        # express the transform found at the analysis resolution at the full
+        # resolution
+        scaling = numpy.diag((self.downscale, self.downscale, 1.))
+        transform = scaling.dot(transform).dot(numpy.linalg.inv(scaling))
+        return transform, blob1
+
+    def _remove_rotation(self, img0, small1, blob0, blob1):
+        # Estimates the rotation and scale between img0 and small1, and
+        # returns them with the corresponding transform and the spectrum of
+        # small1 with them undone, so that only a translation remains.
+        blob1.log_polar_spectrum = self._log_polar_spectrum(small1)
+        if blob0.log_polar_spectrum is None:
+            blob0.log_polar_spectrum = \
+                self._log_polar_spectrum(self._prepare(img0))
+        angle, scale = self._rotation_and_scale(blob0.log_polar_spectrum,
+                                                blob1.log_polar_spectrum)
+        transform = self._similarity(small1.shape, angle, scale)
+        unrotated1 = cv2.warpAffine(small1, transform[:2],
+                                    (small1.shape[1], small1.shape[0]),
+                                    flags=cv2.WARP_INVERSE_MAP)
+        spectrum1 = numpy.fft.fft2(unrotated1 * self._window)
+        return angle, scale, transform, spectrum1
+
+    def warp_blob(self, blob, transform_matrix):
+        # the spectrum of a warped image is no cheaper to get than a new FFT
+        return None
+
+    def _prepare(self, img):
+        # we want a 2D float array at the analysis resolution
+        if len(img.shape) == 3:
+            img = img.reshape(img.shape[:2])
+        if self.downscale > 1:
+            img = cv2.resize(img, (img.shape[1] / self.downscale,
+                                   img.shape[0] / self.downscale),
+                             interpolation=cv2.INTER_AREA)
+        img = numpy.float32(img)
+        if self._window is None or self._window.shape != img.shape:
+            # a Hanning window avoids the frame borders dominating the
+            # correlation
+            self._window = numpy.outer(numpy.hanning(img.shape[0]),
+                                       numpy.hanning(img.shape[1]))
+            self._log_polar_maps = None
+        return img
+
+    def _phase_correlate(self, spectrum0, spectrum1):
+        # returns ((dx, dy), response) such that img1(x, y) ~ img0(x-dx, y-dy)
+        cross_power = spectrum1 * spectrum0.conj()
+        cross_power /= numpy.abs(cross_power) + 1e-9
+        correlation = numpy.fft.ifft2(cross_power).real
+
+        height, width = correlation.shape
+        peak_y, peak_x = numpy.unravel_index(correlation.argmax(),
+                                             correlation.shape)
+        # sub-pixel refinement: weighted centroid of the 3x3 neighbourhood
+        ys = numpy.arange(peak_y - 1, peak_y + 2)
+        xs = numpy.arange(peak_x - 1, peak_x + 2)
+        neighbourhood = correlation[ys[:, None] % height, xs % width]
+        neighbourhood = neighbourhood.clip(0, None)
+        total = neighbourhood.sum()
+        if total > 0:
+            dy = (neighbourhood.sum(axis=1) * ys).sum() / total
+            dx = (neighbourhood.sum(axis=0) * xs).sum() / total
+        else:
+            dy, dx = peak_y, peak_x
+
+        # the correlation is circular, big shifts are negative ones
+        if dy > height / 2.:
+            dy -= height
+        if dx > width / 2.:
+            dx -= width
+        return (dx, dy), correlation[peak_y, peak_x]
+
+    def _log_polar_spectrum(self, img):
+        # FFT of the log-polar resampling of the magnitude spectrum of the
+        # biggest centred square of img
+        height, width = img.shape
+        side = min(height, width)
+        top = (height - side) / 2
+        left = (width - side) / 2
+        square = img[top:top + side, left:left + side]
+
+        if self._log_polar_maps is None:
+            self._compute_log_polar_maps(side)
+
+        magnitude = numpy.abs(numpy.fft.fftshift(
+                        numpy.fft.fft2(square * self._square_window)))
+        magnitude = numpy.float32(magnitude * self._high_pass)
+        map_x, map_y = self._log_polar_maps
+        log_polar = cv2.remap(magnitude, map_x, map_y, cv2.INTER_LINEAR)
+        return numpy.fft.fft2(log_polar)
+
+    def _compute_log_polar_maps(self, side):
+        center = side / 2.
+        # angles only go up to pi, the magnitude spectrum is symmetric
+        angles = numpy.arange(side) * math.pi / side
+        self._log_base = math.log(center) / side
+        radii = numpy.exp(numpy.arange(side) * self._log_base)
+        map_x = center + numpy.cos(angles)[:, None] * radii
+        map_y = center + numpy.sin(angles)[:, None] * radii
+        self._log_polar_maps = (numpy.float32(map_x), numpy.float32(map_y))
+
+        self._square_window = numpy.outer(numpy.hanning(side),
+                                          numpy.hanning(side))
+        # a simple high-pass filter so that low frequencies, which are
+        # barely affected by rotation, do not dominate
+        frequencies = numpy.cos(math.pi * (numpy.arange(side) - center) / side)
+        self._high_pass = 1. - numpy.outer(frequencies, frequencies)
+
+    def _rotation_and_scale(self, log_polar0, log_polar1):
+        (d_log_radius, d_angle), _ = self._phase_correlate(log_polar0,
+                                                           log_polar1)
+        side = log_polar0.shape[0]
+        angle = d_angle * math.pi / side
+        # a shift in log-radius of the spectrum is an inverse scaling of the
+        # image
+        scale = math.exp(-d_log_radius * self._log_base)
+        return angle, scale
+
+    def _similarity(self, shape, angle, scale):
+        # transform rotating by angle and scaling by scale around the centre
+        # of a frame of the given shape
+        height, width = shape[:2]
+        center = numpy.asarray((width / 2., height / 2.))
+        cos_a = scale * math.cos(angle)
+        sin_a = scale * math.sin(angle)
+        transform = numpy.eye(3)
+        transform[:2, :2] = ((cos_a, -sin_a), (sin_a, cos_a))
+        transform[:2, 2] = center - transform[:2, :2].dot(center)
+        return transform
+
+
+# algorithm -> function returning a new Finder configured from the properties
+# of the element given as argument
+_finder_factories = {}
+
+def register_finder(algorithm, factory):
+    _finder_factories[algorithm] = factory
+
+def create_finder(algorithm, element):
+    """
+    Returns a new finder for algorithm, configured according to the
+    properties of element.
+    """
+    try:
+        factory = _finder_factories[algorithm]
+    except KeyError:
+        raise ValueError("Unknown algorithm")
+    return factory(element)
+
+register_finder(LUCAS_KANADE,
+                lambda element: LucasKanadeFinder(element.corner_count,
+                                                  element.corner_quality_level,
+                                                  element.corner_min_distance,
+                                                  element.win_size,
+                                                  element.pyramid_level,
+                                                  element.max_iterations,
+                                                  element.epsilon,
+                                                  element.tile_rows,
+                                                  element.tile_columns,
+                                                  element.detection_threads,
+                                                  element.motion_prior,
+                                                  element.prior_downscale))
+register_finder(SURF,
+                lambda element: SURFFinder(element.guided_matching,
+                                           element.search_radius))
+register_finder(PHASE_CORRELATION,
+                lambda element: PhaseCorrelationFinder(element.phase_downscale,
+                                                       element.log_polar))
+
+
+class FrameChangeClassifier(object):
+    """
+    Cheaply tells whether a frame is nearly identical to the previous one, a
+    regular frame, or the first frame after a scene cut, by comparing small
+    thumbnails of consecutive frames. Meant to be run before a Finder, to
+    avoid analysing frames when it is pointless.
+    """
+    STATIC = 0
+    NORMAL = 1
+    CUT = 2
+
+    def __init__(self, static_threshold=1., cut_threshold=.5,
+                 thumbnail_size=(64, 48), histogram_bins=32, *args, **kw):
+        super(FrameChangeClassifier, self).__init__(*args, **kw)
+        # mean absolute difference between thumbnails, in grey levels, under
+        # which a frame is static
+        self.static_threshold = static_threshold
+        # correlation between grey level histograms under which a frame is
+        # after a cut
+        self.cut_threshold = cut_threshold
+        self.thumbnail_size = thumbnail_size
+        self.histogram_bins = histogram_bins
+
+        self._previous = None
+        self._previous_histogram = None
+
+    def classify(self, img):
+        # img is expected to be a grey scale image
+        thumbnail = numpy.float32(cv2.resize(img, self.thumbnail_size,
+                                             interpolation=cv2.INTER_AREA))
+        histogram, _ = numpy.histogram(thumbnail, self.histogram_bins,
+                                       (0, 256))
+
+        previous = self._previous
+        previous_histogram = self._previous_histogram
+        if previous is not None \
+           and numpy.abs(thumbnail - previous).mean() < self.static_threshold:
+            # we keep comparing with the last frame that was not static, so
+            # that a slow drift does not go unnoticed
+            return self.STATIC
+
+        self._previous = thumbnail
+        self._previous_histogram = histogram
+        if previous is None:
+            return self.NORMAL
+
+        if self._correlation(histogram, previous_histogram) < self.cut_threshold:
+            return self.CUT
+        return self.NORMAL
+
+    def reset(self):
+        self._previous = None
+        self._previous_histogram = None
+
+    def _correlation(self, histogram0, histogram1):
+        centered0 = histogram0 - histogram0.mean()
+        centered1 = histogram1 - histogram1.mean()
+        norm = math.sqrt((centered0 ** 2).sum() * (centered1 ** 2).sum())
+        if norm == 0:
+            # at least one of them is flat
+            return 1. if (centered0 == centered1).all() else 0.
+        return (centered0 * centered1).sum() / norm
+
 
 class FinderDemo(object):
     def __init__(self, finder, path0, path1, pathout, *args, **kw):
@@ -327,6 +1039,8 @@ if __name__ == '__main__':
         finder = LucasKanadeFinder()
     elif algorithm == 'SURF':
         finder = SURFFinder()
+    elif algorithm == 'PC':
+        finder = PhaseCorrelationFinder()
     else:
         print "Uknown algorithm!"
         syntax()
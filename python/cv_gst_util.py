@@ -17,7 +17,30 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import cv2, gst, numpy
+import gst
+
+class LazyModule(object):
+    """
+    Stands for a module that is only imported the first time one of its
+    attributes is used. This way, loading the plugins (which GStreamer does
+    when scanning them for its registry) does not import cv2 and numpy, which
+    takes a while; that only happens once an element actually processes
+    something.
+    """
+    def __init__(self, name):
+        self._lazy_name = name
+
+    def __getattr__(self, attr):
+        module = __import__(self._lazy_name)
+        # from now on, attributes are found without going through __getattr__
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return "<lazily imported module '%s'>" % self._lazy_name
+
+cv2 = LazyModule('cv2')
+numpy = LazyModule('numpy')
 
 # note that we only care about what OpticalFlowCorrector supports
 def img_of_buf(buf):
@@ -38,13 +61,49 @@ def img_of_buf(buf):
 def buf_of_img(img, bufmodel=None):
     buf = gst.Buffer(img)
     if bufmodel is not None:
-        buf.caps = bufmodel.caps
+        caps = bufmodel.caps
+        struct = caps[0]
+        if (struct['height'], struct['width']) != img.shape[:2]:
+            caps = caps.copy()
+            caps[0]['height'] = img.shape[0]
+            caps[0]['width'] = img.shape[1]
+        buf.caps = caps
         buf.duration = bufmodel.duration
         buf.timestamp = bufmodel.timestamp
         buf.offset = bufmodel.offset
         buf.offset_end = bufmodel.offset_end
     return buf
 
+def viewport_transform(shape, margin, width=0, height=0):
+    """
+    Returns the size (width, height) of the output for the viewport of a frame
+    of the given shape that leaves out margin (a fraction of the frame width
+    and height) on each side, and the transform from output pixels to frame
+    pixels. The output is width x height, or the size of the frame if both
+    are 0; if only one of them is 0, it keeps the aspect ratio of the
+    viewport.
+    """
+    frame_height, frame_width = shape[:2]
+    left = frame_width * margin
+    top = frame_height * margin
+    viewport_width = frame_width - 2 * left
+    viewport_height = frame_height - 2 * top
+
+    if width <= 0 and height <= 0:
+        width, height = frame_width, frame_height
+    elif width <= 0:
+        width = int(round(height * viewport_width / viewport_height))
+    elif height <= 0:
+        height = int(round(width * viewport_height / viewport_width))
+
+    scale_x = viewport_width / float(width)
+    scale_y = viewport_height / float(height)
+    # output pixel centres go to the viewport pixel centres
+    transform = numpy.asarray([[scale_x, 0., left + (scale_x - 1) / 2.],
+                               [0., scale_y, top + (scale_y - 1) / 2.],
+                               [0., 0., 1.]])
+    return (width, height), transform
+
 def gray_scale(img):
     new_img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
     return new_img
@@ -19,14 +19,248 @@
 
 import gobject,gst
 
-import cv2
-import numpy
+import Queue
+import threading
+import time
+import traceback
 
 from cv_gst_util import *
+import flow_trace
 
 from flow_muxer import OpticalFlowMuxer
 
-from cv_flow_finder import LucasKanadeFinder, SURFFinder
+import cv_flow_finder
+from cv_flow_finder import FrameChangeClassifier, transform_from_flow, \
+                           grid_flow
+from lens_correction import create_lens_correction
+from transform_cache import create_transform_cache
+
+
+class AsyncAnalysis(object):
+    """
+    Runs analyse(buf) in a separate thread, always on the most recent buffer
+    submitted, and keeps track of the transforms it returns to extrapolate a
+    transform for any timestamp.
+    analyse() should return a (transform, transformed image) pair, as
+    OpticalFlowCorrector._analyse() does. If it raises an exception, the
+    analysis stops and failed(message, debug) is called from its thread.
+    """
+    def __init__(self, analyse, failed, *args, **kw):
+        super(AsyncAnalysis, self).__init__(*args, **kw)
+        self._analyse = analyse
+        self._failed = failed
+
+        self._changed = threading.Condition()
+        self._pending = None
+        self._in_progress = None
+        # timestamp, transform and transformed image of the last analysis
+        self._result = None
+        # last (timestamp, transform) pairs
+        self._trajectory = []
+        self._stopping = False
+        # set when analyse() raised an exception
+        self.error = None
+        # incremented on each flush, so that the analysis of a buffer from
+        # before it is ignored
+        self._generation = 0
+        self._flushing = False
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, buf):
+        with self._changed:
+            if self._flushing or self.error is not None:
+                return
+            if self._pending is not None:
+                print "analysis is late, skipping frame %.4f" \
+                        % (self._pending.timestamp / float(gst.SECOND))
+            self._pending = buf
+            self._changed.notify_all()
+
+    def result(self, timestamp, timeout):
+        """
+        Returns the transform for timestamp and the transformed image, if the
+        analysis of that frame finishes within timeout seconds. Otherwise,
+        returns a transform extrapolated from the last ones and None.
+        """
+        end = time.time() + timeout
+        with self._changed:
+            while not self._has_result(timestamp) \
+                  and self.error is None \
+                  and timestamp in self._waiting_timestamps():
+                remaining = end - time.time()
+                if remaining <= 0:
+                    break
+                self._changed.wait(remaining)
+
+            if self._has_result(timestamp):
+                _, transform, new_img = self._result
+                return transform, new_img
+            return self._extrapolate(timestamp), None
+
+    def flush(self):
+        # forgets everything about the buffers before a seek, and ignores new
+        # ones until flush_stop()
+        with self._changed:
+            self._flushing = True
+            self._generation += 1
+            self._pending = None
+            self._result = None
+            self._trajectory = []
+            self._changed.notify_all()
+
+    def flush_stop(self):
+        with self._changed:
+            self._flushing = False
+
+    def stop(self):
+        with self._changed:
+            self._stopping = True
+            self._changed.notify_all()
+        self._thread.join()
+
+    def _has_result(self, timestamp):
+        return self._result is not None and self._result[0] == timestamp
+
+    def _waiting_timestamps(self):
+        return [buf.timestamp for buf in (self._pending, self._in_progress)
+                              if buf is not None]
+
+    def _extrapolate(self, timestamp):
+        # linear extrapolation from the last two transforms, at most one
+        # interval between them ahead
+        if not self._trajectory:
+            return None
+        timestamp1, transform1 = self._trajectory[-1]
+        if len(self._trajectory) < 2 or timestamp == gst.CLOCK_TIME_NONE \
+           or timestamp1 == gst.CLOCK_TIME_NONE:
+            return transform1
+        timestamp0, transform0 = self._trajectory[-2]
+        if timestamp1 <= timestamp0 or timestamp0 == gst.CLOCK_TIME_NONE:
+            return transform1
+        ratio = (timestamp - timestamp1) / float(timestamp1 - timestamp0)
+        ratio = min(max(ratio, 0.), 1.)
+        return transform1 + (transform1 - transform0) * ratio
+
+    def _run(self):
+        while True:
+            with self._changed:
+                while self._pending is None and not self._stopping:
+                    self._changed.wait()
+                if self._stopping:
+                    return
+                buf = self._in_progress = self._pending
+                self._pending = None
+                generation = self._generation
+
+            try:
+                transform, new_img = self._analyse(buf)
+            except Exception, e:
+                with self._changed:
+                    self._in_progress = None
+                    self.error = e
+                    self._changed.notify_all()
+                self._failed("analysis failed: %s" % e, traceback.format_exc())
+                return
+
+            with self._changed:
+                self._in_progress = None
+                if generation != self._generation:
+                    # flushed while we were at it
+                    self._changed.notify_all()
+                    continue
+                self._result = (buf.timestamp, transform, new_img)
+                if transform is None:
+                    # first frame, scene cut or failure: what happened before
+                    # does not tell anything about what comes next
+                    self._trajectory = []
+                else:
+                    self._trajectory = self._trajectory[-1:] \
+                                       + [(buf.timestamp, transform)]
+                self._changed.notify_all()
+
+
+class PipelinedRenderer(object):
+    """
+    Calls render(buf, transform, new_img) from a separate thread, so that a
+    frame can be transformed and pushed while the next one is analysed. At
+    most max_size frames wait to be rendered. Events sent downstream go
+    through the same queue, so that they stay in order with the buffers.
+    """
+    def __init__(self, render, srcpad, name, max_size=2, *args, **kw):
+        super(PipelinedRenderer, self).__init__(*args, **kw)
+        self._render = render
+        self._name = name
+        self._srcpad = srcpad
+        self._queue = Queue.Queue(max_size)
+        self._lock = threading.Lock()
+        # what the last push returned, given back to upstream with the next
+        # buffer
+        self._last_return = gst.FLOW_OK
+        # incremented on flush start and stop, what was queued before is
+        # dropped
+        self._generation = 0
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def push_buffer(self, buf, transform, new_img):
+        # blocks while the queue is full
+        self._queue.put(('buffer', self._generation, (buf, transform, new_img)))
+        with self._lock:
+            return self._last_return
+
+    def push_event(self, event):
+        self._queue.put(('event', self._generation, event))
+        return True
+
+    def flush(self):
+        # drops everything waiting to be rendered, and what gets queued until
+        # flush_stop(), as it was sent before the flush
+        with self._lock:
+            self._generation += 1
+        self._drain()
+
+    def flush_stop(self):
+        with self._lock:
+            self._generation += 1
+            self._last_return = gst.FLOW_OK
+        self._drain()
+
+    def stop(self):
+        self.flush()
+        self._queue.put(('stop', self._generation, None))
+        self._thread.join()
+
+    def _drain(self):
+        try:
+            while True:
+                self._queue.get_nowait()
+                self._queue.task_done()
+        except Queue.Empty:
+            pass
+
+    def _run(self):
+        while True:
+            kind, generation, item = self._queue.get()
+            try:
+                if kind == 'stop':
+                    return
+                elif generation != self._generation:
+                    continue
+                elif kind == 'buffer':
+                    with flow_trace.frame(self._name, item[0]):
+                        ret = self._render(*item)
+                    with self._lock:
+                        if generation == self._generation:
+                            self._last_return = ret
+                else:
+                    self._srcpad.push_event(item)
+            finally:
+                self._queue.task_done()
 
 
 class OpticalFlowCorrector(gst.Element):
@@ -45,8 +279,9 @@ class OpticalFlowCorrector(gst.Element):
     __gsttemplates__ = (sink_template, src_template)
 
     # Algorithms to chose from:
-    LUCAS_KANADE = 1
-    SURF = 2
+    LUCAS_KANADE = cv_flow_finder.LUCAS_KANADE
+    SURF = cv_flow_finder.SURF
+    PHASE_CORRELATION = cv_flow_finder.PHASE_CORRELATION
 
     corner_count = gobject.property(type=int,
                                  default=50,
@@ -69,6 +304,24 @@ class OpticalFlowCorrector(gst.Element):
     epsilon = gobject.property(type=float,
                                     default=0.001,
                                     blurb='terminate when we reach that difference or smaller')
+    tile_rows = gobject.property(type=int,
+                                 default=1,
+                                 blurb='number of rows of tiles in which corners are detected in parallel, each tile getting its share of corner-count')
+    tile_columns = gobject.property(type=int,
+                                    default=1,
+                                    blurb='number of columns of tiles in which corners are detected in parallel, each tile getting its share of corner-count')
+    detection_threads = gobject.property(type=int,
+                                         default=0,
+                                         blurb='number of threads detecting corners in tiles, one per tile if 0')
+    motion_prior = gobject.property(type=int,
+                                    default=0,
+                                    blurb="""Lucas Kanade: how to guess where corners went before refining, which allows for fewer pyramid levels, a smaller window and fewer iterations:
+                                    0: no guess
+                                    1: extrapolate from the previous frame
+                                    2: coarse phase correlation""")
+    prior_downscale = gobject.property(type=int,
+                                       default=4,
+                                       blurb='factor by which frames are downscaled for the coarse phase correlation of motion-prior')
 
     ignore_box_min_x = gobject.property(type=int,
                                         default=-1,
@@ -86,10 +339,84 @@ class OpticalFlowCorrector(gst.Element):
                                  default=LUCAS_KANADE,
                                  blurb= """algorithm to use:
                                  %d: Lucas Kanade (discreet, fast, precise, not good for big changes between frames)
-                                 %d: SURF (Speeded Up Robust Feature, finds features, finds them again)""" % (LUCAS_KANADE, SURF))
+                                 %d: SURF (Speeded Up Robust Feature, finds features, finds them again)
+                                 %d: Phase correlation (no features, very fast, mostly for translations)""" % (LUCAS_KANADE, SURF, PHASE_CORRELATION))
+    phase_downscale = gobject.property(type=int,
+                                       default=1,
+                                       blurb='phase correlation: factor by which frames are downscaled before analysis')
+    log_polar = gobject.property(type=bool,
+                                 default=False,
+                                 blurb='phase correlation: also estimate rotation and scale with a log-polar transform (slower)')
+    guided_matching = gobject.property(type=bool,
+                                       default=False,
+                                       blurb='SURF: only compare features with those found near where the previous motion would move them, instead of searching the whole frame')
+    search_radius = gobject.property(type=int,
+                                     default=30,
+                                     minimum=1,
+                                     blurb='SURF: distance in pixels around the predicted position in which features are compared when guided-matching is set')
     multiply_transforms = gobject.property(type=bool,
                                            default=False,
                                            blurb='whether to multiply transform matrices, or to compare transformed images instead)')
+    analysis_deadline = gobject.property(type=int,
+                                         default=-1,
+                                         blurb='if not -1, analyse frames in a separate thread, and wait at most that many milliseconds for the analysis of a frame before transforming it with a transform extrapolated from the previous ones')
+    pipelined = gobject.property(type=bool,
+                                 default=False,
+                                 blurb='transform and push each frame in a separate thread, while the next frame is analysed; unless multiply-transforms is set, the next frame is compared with the transformed one, which is then transformed during the analysis and only pushed separately, if crop-margin, output-width and output-height are not set either')
+    change_detection = gobject.property(type=bool,
+                                        default=False,
+                                        blurb='compare thumbnails of consecutive frames to skip the analysis of static frames and detect scene cuts')
+    static_threshold = gobject.property(type=float,
+                                        default=1.,
+                                        blurb='change detection: mean grey level difference between thumbnails under which a frame is considered static')
+    cut_threshold = gobject.property(type=float,
+                                     default=.5,
+                                     blurb='change detection: histogram correlation under which a frame is considered to be after a scene cut')
+    transform_cache = gobject.property(type=str,
+                                       default='',
+                                       blurb='file where the transform of each frame is kept, so that it can be found again after a seek or in a later run; only kept in memory if empty and cache-size is set')
+    cache_size = gobject.property(type=int,
+                                  default=0,
+                                  minimum=0,
+                                  blurb='number of frames whose transform is kept to be found again after a seek, the least recently used ones being forgotten first; no limit if 0 and transform-cache is set, nothing kept if both are unset')
+    lens_fx = gobject.property(type=float,
+                               default=0.,
+                               blurb='focal length of the camera along x, in pixels; if not 0, lens distortion is removed in the same pass as the stabilisation')
+    lens_fy = gobject.property(type=float,
+                               default=0.,
+                               blurb='focal length of the camera along y, in pixels; the same as lens-fx if 0')
+    lens_cx = gobject.property(type=float,
+                               default=-1.,
+                               blurb='x coordinate of the optical centre, in pixels; centre of the frame if negative')
+    lens_cy = gobject.property(type=float,
+                               default=-1.,
+                               blurb='y coordinate of the optical centre, in pixels; centre of the frame if negative')
+    lens_k1 = gobject.property(type=float,
+                               default=0.,
+                               blurb='first radial distortion coefficient')
+    lens_k2 = gobject.property(type=float,
+                               default=0.,
+                               blurb='second radial distortion coefficient')
+    lens_k3 = gobject.property(type=float,
+                               default=0.,
+                               blurb='third radial distortion coefficient')
+    lens_p1 = gobject.property(type=float,
+                               default=0.,
+                               blurb='first tangential distortion coefficient')
+    lens_p2 = gobject.property(type=float,
+                               default=0.,
+                               blurb='second tangential distortion coefficient')
+    crop_margin = gobject.property(type=float,
+                                   default=0.,
+                                   minimum=0.,
+                                   maximum=.49,
+                                   blurb='if not 0, only output the centre of the stabilised frames, leaving out that fraction of their width and height on each side, so that the parts not covered by the frame after the transform are rarely seen')
+    output_width = gobject.property(type=int,
+                                    default=0,
+                                    blurb='width to which the output is scaled, in the same pass as the stabilisation; that of the input if 0 (and output-height is 0 too), or keeping the aspect ratio if only output-height is set')
+    output_height = gobject.property(type=int,
+                                     default=0,
+                                     blurb='height to which the output is scaled, in the same pass as the stabilisation; that of the input if 0 (and output-width is 0 too), or keeping the aspect ratio if only output-width is set')
 
     def __init__(self, *args, **kw):
         super(OpticalFlowCorrector, self).__init__(*args, **kw)
@@ -99,52 +426,171 @@ class OpticalFlowCorrector(gst.Element):
 
         self.sinkpad = gst.Pad(self.sink_template)
         self.sinkpad.set_chain_function(self._chain)
+        self.sinkpad.set_event_function(self._sink_event)
         self.add_pad(self.sinkpad)
 
         self._reference_img = None
+        # gray version of _reference_img, kept so that the finder is given
+        # the same reference it saw as its last frame
+        self._reference_gray = None
         self._reference_blob = None
         self._last_output_img = None
-        self._reference_transform = numpy.asarray([[1., 0., 0.],
-                                                   [0., 1., 0.],
-                                                   [0., 0., 1.]],
-                                                   dtype=numpy.float128)
+        # set with the first frame
+        self._reference_transform = None
+        # set when flushed, the next frame does not follow the last one
+        self._flushed = False
+        # protects self._flushed and self._last_output_img, set when flushed
+        # while the analysis and rendering threads use them
+        self._state_lock = threading.Lock()
+        self._cache = None
+        self._lens = None
+        # output (width, height) and transform from output to frame pixels,
+        # when cropping or scaling
+        self._viewport = None
 
         self._finder = None
+        self._classifier = None
+        self._async_analysis = None
+        self._renderer = None
 
     def _create_finder(self):
-
-        if self.algorithm == self.LUCAS_KANADE:
-            finder = LucasKanadeFinder(self.corner_count,
-                                             self.corner_quality_level,
-                                             self.corner_min_distance,
-                                             self.win_size,
-                                             self.pyramid_level,
-                                             self.max_iterations,
-                                             self.epsilon)
-        elif self.algorithm == self.SURF:
-            finder = SURFFinder()
-        else:
-            raise ValueError("Unknown algorithm")
-        return finder
+        return cv_flow_finder.create_finder(self.algorithm, self)
 
     def _chain(self, pad, buf):
-        if self._reference_img is None:
-            self._reference_img = img_of_buf(buf)
-            self._last_output_img = self._reference_img
+        with flow_trace.frame(self.get_name(), buf):
+            return self._process(buf)
+
+    def _sink_event(self, pad, event):
+        if event.type == gst.EVENT_EOS:
+            flow_trace.flush()
+        elif event.type == gst.EVENT_FLUSH_START:
+            if self._async_analysis is not None:
+                self._async_analysis.flush()
+        elif event.type == gst.EVENT_FLUSH_STOP:
+            # the analysis state is reset by the thread doing the analysis
+            with self._state_lock:
+                self._flushed = True
+                self._last_output_img = None
+            if self._async_analysis is not None:
+                self._async_analysis.flush_stop()
+        if self._renderer is None:
+            return pad.event_default(event)
+        elif event.type == gst.EVENT_FLUSH_STOP:
+            self._renderer.flush_stop()
+            return pad.event_default(event)
+        elif event.type == gst.EVENT_FLUSH_START:
+            # forward it first so that a push blocked downstream returns
+            ret = pad.event_default(event)
+            self._renderer.flush()
+            return ret
+        else:
+            return self._renderer.push_event(event)
+
+    def _process(self, buf):
+        if self._lens is None:
+            self._lens = create_lens_correction(self, img_of_buf(buf).shape)
+        if self._viewport is None and self._uses_viewport():
+            self._viewport = viewport_transform(img_of_buf(buf).shape,
+                                                self.crop_margin,
+                                                self.output_width,
+                                                self.output_height)
+
+        if self.analysis_deadline < 0:
+            transform, new_img = self._analyse(buf)
+        else:
+            if self._async_analysis is None:
+                self._async_analysis = AsyncAnalysis(self._analyse,
+                                                     self._analysis_failed)
+            self._async_analysis.submit(buf)
+            with flow_trace.span('wait'):
+                transform, new_img = self._async_analysis.result(
+                        buf.timestamp, self.analysis_deadline / 1000.)
+            if self._async_analysis.error is not None:
+                return gst.FLOW_ERROR
+
+        if self.pipelined:
+            if self._renderer is None:
+                self._renderer = PipelinedRenderer(self._render, self.srcpad,
+                                                   self.get_name() + '-render')
+            return self._renderer.push_buffer(buf, transform, new_img)
+        return self._render(buf, transform, new_img)
+
+    def _analysis_failed(self, message, debug):
+        error = gst.GError(gst.STREAM_ERROR, gst.STREAM_ERROR_FAILED, message)
+        self.post_message(gst.message_new_error(self, error, debug))
+
+    def _analyse(self, buf):
+        """
+        Updates the reference with buf, and returns the transform to apply to
+        buf, or None to leave it untouched, with the transformed frame if it
+        had to be computed.
+        """
+        with self._state_lock:
+            flushed, self._flushed = self._flushed, False
+        if flushed:
+            self._set_reference(None)
+            self._reference_blob = None
+            if self._classifier is not None:
+                self._classifier.reset()
+
+        gray_img = None
+        change = FrameChangeClassifier.NORMAL
+        if self.change_detection:
+            if self._classifier is None:
+                self._classifier = FrameChangeClassifier(self.static_threshold,
+                                                         self.cut_threshold)
+            with flow_trace.span('gray'):
+                gray_img = gray_scale(img_of_buf(buf))
+            with flow_trace.span('classify'):
+                change = self._classifier.classify(gray_img)
+
+        if self._reference_img is None and change != FrameChangeClassifier.CUT \
+           and self._cache is not None:
+            transform = self._cache.lookup_buffer(buf)
+            if transform is not None:
+                return self._restore(buf, transform)
+
+        if self._reference_img is None or change == FrameChangeClassifier.CUT:
+            if self._reference_img is not None:
+                print "scene cut detected, starting over"
+            transform = numpy.eye(3, dtype=numpy.float128)
+            self._remember(buf, transform)
+            if self._lens is not None:
+                # the frame still needs to be undistorted
+                return self._start_from(buf, transform)
+            self._set_reference(img_of_buf(buf), gray_img)
             self._reference_blob = None
-            return self.srcpad.push(buf)
+            self._reference_transform = transform
+            return None, None
+
+        if change == FrameChangeClassifier.STATIC:
+            # nothing moved since the last analysed frame, its transform is
+            # still the right one
+            self._remember(buf, self._reference_transform)
+            return self._reference_transform, None
 
         if self._finder is None:
             self._finder = self._create_finder()
 
         print "-- buf timestamp: %.4f" % (buf.timestamp/float(gst.SECOND))
 
-        flow,blob = self._get_flow(buf)
+        if gray_img is None:
+            with flow_trace.span('gray'):
+                gray_img = gray_scale(img_of_buf(buf))
+        flow,blob = self._get_flow(buf, gray_img)
         if flow is None:
-            return self.srcpad.push(buf)
+            return None, None
 
         try:
-            transform = self._perspective_transform_from_flow(flow)
+            transform, inliers = self._perspective_transform_from_flow(
+                    flow, gray_img.shape)
+            if transform is None:
+                print "not enough points for a transform, not applying any transform for this frame"
+                self._set_reference(img_of_buf(buf), gray_img)
+                self._reference_blob = None
+                return None, None
+            # outliers would only make the next estimate worse
+            blob = self._finder.drop_outliers(blob, inliers)
 
             if self.props.multiply_transforms:
                 # since we get the flow between original frames, we need to
@@ -153,41 +599,202 @@ class OpticalFlowCorrector(gst.Element):
                     transform.dot(self._reference_transform)
             else:
                 self._reference_transform = transform
+            self._remember(buf, self._reference_transform)
 
             img = img_of_buf(buf)
+            if self.props.multiply_transforms:
+                self._set_reference(img, gray_img)
+                self._reference_blob = blob
+                return self._reference_transform, None
+            else:
+                # we compare the next frame with this one once transformed
+                if self._viewport is None:
+                    new_img = self._warp(img, self._reference_transform,
+                                         self._reference_img)
+                    self._set_reference(new_img)
+                else:
+                    # the output only needs the viewport, computed from buf
+                    # when rendering: the finder only needs gray levels
+                    new_img = None
+                    reference = self._warp(gray_img,
+                                           self._reference_transform,
+                                           self._reference_gray)
+                    self._set_reference(reference, reference)
+                if self._lens is None:
+                    self._reference_blob = self._finder.warp_blob(blob,
+                                                                  transform)
+                else:
+                    # the blob is made of distorted points, the features will
+                    # be found again in the reference
+                    self._reference_blob = None
+                return self._reference_transform, new_img
+        except cv2.error,e :
+            print "got an opencv error (%s), not applying any transform for this frame" % e.message
+            self._set_reference(img_of_buf(buf), gray_img)
+            self._reference_blob = None
+            return None, None
+
+    def _restore(self, buf, transform):
+        # after a seek to a frame we saw already: we go on from the transform
+        # we had for it, without having to analyse the frames before it
+        print "restoring transform for frame %.4f" \
+            % (buf.timestamp / float(gst.SECOND))
+        return self._start_from(buf, transform)
+
+    def _remember(self, buf, transform):
+        if self._cache is not None:
+            self._cache.add(buf.timestamp, transform)
+
+    def _start_from(self, buf, transform):
+        # makes buf, transformed with transform, the new reference
+        img = img_of_buf(buf)
+        self._reference_transform = transform
+        self._reference_blob = None
+        if self._viewport is not None:
+            # the viewport is computed from buf when rendering
+            if self.props.multiply_transforms:
+                self._set_reference(img)
+            else:
+                gray_img = gray_scale(img)
+                background = None
+                if self._lens is None:
+                    background = gray_img
+                reference = self._warp(gray_img, transform, background)
+                self._set_reference(reference, reference)
+            return transform, None
+
+        if self._lens is None:
+            new_img = self._warp(img, transform, img)
+        else:
+            new_img = self._warp(img, transform, None)
+        if self.props.multiply_transforms:
+            self._set_reference(img)
+        else:
+            self._set_reference(new_img)
+        return transform, new_img
+
+    def _set_reference(self, img, gray_img=None):
+        # gray_img, if given, must be the gray version of img
+        self._reference_img = img
+        self._reference_gray = gray_img
+
+    def _render(self, buf, transform, new_img=None):
+        if transform is None:
+            if self._lens is None and self._viewport is None:
+                with self._state_lock:
+                    self._last_output_img = img_of_buf(buf)
+                return self.srcpad.push(buf)
+            # the frame still needs to be undistorted or cropped
+            transform = numpy.eye(3)
+
+        if self._viewport is not None:
+            # nothing to keep from the last output, and only the pixels of the
+            # viewport are computed, straight from the frame
+            new_img = self._warp_viewport(img_of_buf(buf), transform)
+            with flow_trace.span('push'):
+                return self.srcpad.push(buf_of_img(new_img, bufmodel=buf))
+
+        if new_img is None:
+            img = img_of_buf(buf)
+            with self._state_lock:
+                background = self._last_output_img
+            if background is None and self._lens is None:
+                # first frame after a seek
+                background = img
+            new_img = self._warp(img, transform, background)
+        with self._state_lock:
+            self._last_output_img = new_img
+        with flow_trace.span('push'):
+            return self.srcpad.push(buf_of_img(new_img, bufmodel=buf))
 
-            new_img = self._last_output_img.copy()
-            
+    def _warp(self, img, transform, background):
+        # parts of the frame that img does not cover after the transform are
+        # taken from background (from the borders of img if None, only with
+        # lens correction)
+        if self._lens is not None:
+            return self._lens.warp(img, transform, background)
+
+        new_img = background.copy()
+
+        with flow_trace.span('warp'):
             new_img = cv2.warpPerspective(img,
-                                          numpy.asarray(self._reference_transform,
+                                          numpy.asarray(transform,
                                                         dtype=numpy.float64),
                                           (img.shape[1], img.shape[0]),
                                           dst=new_img,
                                           flags=cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_TRANSPARENT)
+        return new_img
+
+    def _uses_viewport(self):
+        return self.crop_margin > 0 or self.output_width > 0 \
+               or self.output_height > 0
+
+    def _warp_viewport(self, img, transform):
+        # only computes the pixels of the viewport, from the nearest border of
+        # the frame when it does not cover them
+        size, viewport = self._viewport
+        transform = numpy.asarray(transform, dtype=numpy.float64).dot(viewport)
+        if self._lens is not None:
+            return self._lens.warp(img, transform, None, size=size)
+
+        with flow_trace.span('warp'):
+            return cv2.warpPerspective(img, transform, size,
+                                       flags=cv2.WARP_INVERSE_MAP,
+                                       borderMode=cv2.BORDER_REPLICATE)
+
+    def do_change_state(self, state_change):
+        if state_change == gst.STATE_CHANGE_NULL_TO_READY:
+            self._finder = self._create_finder()
+            self._cache = create_transform_cache(self)
+        elif state_change == gst.STATE_CHANGE_READY_TO_NULL:
+            if self._finder is not None:
+                self._finder.close()
+            self._finder = None
+            self._classifier = None
+            self._cache = None
+            self._lens = None
+            self._viewport = None
+        elif state_change == gst.STATE_CHANGE_PAUSED_TO_READY:
+            # wakes up a chain waiting for them, so that the pads can be
+            # deactivated
+            if self._async_analysis is not None:
+                self._async_analysis.flush()
+            if self._renderer is not None:
+                self._renderer.flush()
+
+        ret = gst.Element.do_change_state(self, state_change)
+
+        if state_change == gst.STATE_CHANGE_PAUSED_TO_READY:
+            # the pads are deactivated: no chain can use or create them again
+            if self._async_analysis is not None:
+                self._async_analysis.stop()
+                self._async_analysis = None
+            if self._renderer is not None:
+                self._renderer.stop()
+                self._renderer = None
+            if self._cache is not None:
+                self._cache.save()
 
-            new_buf = buf_of_img(new_img, bufmodel=buf)
-            if self.props.multiply_transforms:
-                self._reference_img = img
-                self._reference_blob = blob
-            else:
-                self._reference_img = new_img
-                self._reference_blob = self._finder.warp_blob(blob, transform)
-            self._last_output_img = new_img
-            return self.srcpad.push(new_buf)
-        except cv2.error,e :
-            print "got an opencv error (%s), not applying any transform for this frame" % e.message
-            self._reference_img = img_of_buf(buf)
-            self._reference_blob = None
-            return self.srcpad.push(buf)
+        return ret
 
-    def _perspective_transform_from_flow(self, (points0, points1)):
-        # Ransac and its threshold allow us to easily weed out outliers.
-        transform, mask = cv2.findHomography(points0, points1,
-                                             method=cv2.RANSAC,
-                                             ransacReprojThreshold=3)
-        return transform
+    def _perspective_transform_from_flow(self, flow, shape):
+        if self._lens is not None:
+            # we warp undistorted frames, so we need the homography between
+            # undistorted frames. The reference is only distorted if it is
+            # the previous input frame.
+            if self.algorithm == self.PHASE_CORRELATION:
+                # the flow is only made of the corners, which get undistorted
+                # far off: we spread the transform over the frame instead
+                transform, _ = transform_from_flow(flow)
+                flow = grid_flow(shape, transform)
+            points0, points1 = flow
+            if self.props.multiply_transforms:
+                points0 = self._lens.undistort_points(points0)
+            flow = (points0, self._lens.undistort_points(points1))
+        with flow_trace.span('ransac'):
+            return transform_from_flow(flow)
 
-    def _get_flow(self, buf):
+    def _get_flow(self, buf, gray_img=None):
 
         if self.algorithm == self.LUCAS_KANADE \
                            and self._finder.mask is None \
@@ -204,11 +811,15 @@ class OpticalFlowCorrector(gst.Element):
                     data[y*height + x] = 0
             cv.SetData(self._finder.mask, data.tostring())
 
-        color_img = img_of_buf(buf)
-        gray_img = gray_scale(color_img)
-        gray_ref_img = gray_scale(self._reference_img)
+        with flow_trace.span('gray'):
+            if gray_img is None:
+                gray_img = gray_scale(img_of_buf(buf))
+            if self._reference_gray is None:
+                self._reference_gray = gray_scale(self._reference_img)
 
-        ret = self._finder.optical_flow_img(gray_ref_img, gray_img,
+        # the finder may keep what it computed for its last frame, which is
+        # only found again if we give it the very same reference
+        ret = self._finder.optical_flow_img(self._reference_gray, gray_img,
                                              self._reference_blob)
         return ret
 
@@ -21,11 +21,11 @@ import gobject,gst
 
 import math
 
-import cv2
-
 from cv_gst_util import *
+import flow_trace
 
 from flow_muxer import OpticalFlowMuxer
+from cv_flow_finder import is_scene_cut, flow_points, transform_from_flow
 
 
 class ArrowDrawer(object):
@@ -33,45 +33,58 @@ class ArrowDrawer(object):
     cos_alpha = math.cos(alpha)
     sin_alpha = math.sin(alpha)
 
-    def __init__(self, width=2, *args, **kw):
+    def __init__(self, width=2, color=(255, 0, 0), *args, **kw):
         super(ArrowDrawer, self).__init__(*args, **kw)
 
         self._width = width
+        self._color = color
 
-    def draw_arrows(self, img, origins, ends):
-        for origin, end in zip(origins, ends):
-            self.draw_arrow(img, origin, end)
-
-    def draw_arrow(self, img, origin, end):
-        color = (255, 0, 0)
-        def int_pos((x,y)):
-            return (int(x), int(y))
-        origin = int_pos(origin)
-        end = int_pos(end)
-        cv2.line(img, origin, end, color, self._width)
-        points = self._compute_arrow_points(origin, end)
-        if points is None:
+    def draw_arrows(self, img, origins, ends, color=None):
+        # All the arrows are drawn with a single polylines call, each arrow
+        # being the open polyline A -> B -> C -> B -> D, where A is the origin,
+        # B the end and C and D the ends of the tip.
+        if len(origins) == 0:
             return
-        C, D = points
-        cv2.line(img, end, C, color, self._width)
-        cv2.line(img, end, D, color, self._width)
-
-    def _compute_arrow_points(self, (xa, ya), (xb, yb), length=20.):
-        # The arrow tip is made by joining B (xb, yb) to C and D. This method
-        # computes the coordinates of C and D.
-        ab_distance = math.sqrt( (xb - xa)**2 + (yb-ya)**2)
-        if ab_distance == 0.:
-            return None
-        cos_beta = (xa - xb) / ab_distance
-        sin_beta = (ya - yb) / ab_distance
+        if color is None:
+            color = self._color
+        origins = numpy.asarray(origins, dtype=numpy.float64).reshape(-1, 2)
+        ends = numpy.asarray(ends, dtype=numpy.float64).reshape(-1, 2)
+        C, D = self._compute_arrow_points(origins, ends)
+
+        arrows = numpy.empty((len(origins), 5, 2), dtype=numpy.int32)
+        arrows[:, 0] = origins
+        arrows[:, 1] = ends
+        arrows[:, 2] = C
+        arrows[:, 3] = ends
+        arrows[:, 4] = D
+        cv2.polylines(img, list(arrows), False, color, self._width)
+
+    def draw_arrow(self, img, origin, end, color=None):
+        self.draw_arrows(img, [origin], [end], color)
+
+    def _compute_arrow_points(self, origins, ends, length=20.):
+        # The arrow tip is made by joining B (ends) to C and D. This method
+        # computes the coordinates of C and D for all the arrows at once. For
+        # arrows of null length, C and D are B.
+        delta = origins - ends
+        ab_distance = numpy.sqrt((delta ** 2).sum(axis=1))
+        null = ab_distance == 0.
+        ab_distance[null] = 1.
+        cos_beta = delta[:, 0] / ab_distance
+        sin_beta = delta[:, 1] / ab_distance
+        cos_beta[null] = 0.
+        sin_beta[null] = 0.
         cos_alpha = self.cos_alpha
         sin_alpha = self.sin_alpha
-        xc = xb + length * (cos_alpha * cos_beta - sin_alpha * sin_beta)
-        yc = yb + length * (sin_beta * cos_alpha + sin_alpha * cos_beta)
-        xd = xb + length * (cos_alpha * cos_beta + sin_alpha * sin_beta)
-        yd = yb + length * (sin_beta * cos_alpha - sin_alpha * cos_beta)
 
-        return ((int(xc), int(yc)), (int(xd), int(yd)))
+        C = numpy.empty_like(ends)
+        D = numpy.empty_like(ends)
+        C[:, 0] = ends[:, 0] + length * (cos_alpha * cos_beta - sin_alpha * sin_beta)
+        C[:, 1] = ends[:, 1] + length * (sin_beta * cos_alpha + sin_alpha * cos_beta)
+        D[:, 0] = ends[:, 0] + length * (cos_alpha * cos_beta + sin_alpha * sin_beta)
+        D[:, 1] = ends[:, 1] + length * (sin_beta * cos_alpha - sin_alpha * cos_beta)
+
+        return C, D
 
 
 class OpticalFlowDrawer(OpticalFlowMuxer):
@@ -94,29 +107,82 @@ class OpticalFlowDrawer(OpticalFlowMuxer):
     line_thickness = gobject.property(type=int,
                                       default=2,
                                       blurb='thickness of the lines used to draw the arrow')
+    max_arrows = gobject.property(type=int,
+                                  default=0,
+                                  blurb='maximum number of arrows to draw, evenly picked among the flow vectors; no limit if 0')
+    show_outliers = gobject.property(type=bool,
+                                     default=False,
+                                     blurb='draw the vectors rejected by RANSAC in a different colour')
+    max_queue_size = gobject.property(type=int,
+                                      default=OpticalFlowMuxer.max_queue_size,
+                                      blurb='maximum number of buffers waiting for their counterpart on each sink pad, no limit if 0')
+    max_queue_time = gobject.property(type=gobject.TYPE_UINT64,
+                                      default=OpticalFlowMuxer.max_queue_time,
+                                      blurb='maximum timestamp difference (in ns) between buffers waiting on a sink pad, no limit if 0')
+    overflow_policy = gobject.property(type=int,
+                                       default=OpticalFlowMuxer.overflow_policy,
+                                       blurb="""what to do when a sink pad has too many buffers waiting:
+                                       %d: drop the oldest one
+                                       %d: block until there is room""" % (OpticalFlowMuxer.DROP_OLDEST, OpticalFlowMuxer.BLOCK))
+    queue_latency = gobject.property(type=gobject.TYPE_UINT64,
+                                     getter=OpticalFlowMuxer._get_queue_latency,
+                                     blurb='how long (in ns) the last frame waited for its flow or the other way round, read-only')
+
+    INLIER_COLOR = (255, 0, 0)
+    OUTLIER_COLOR = (255, 255, 0)
 
     def __init__(self, *args, **kw):
         super(OpticalFlowDrawer, self).__init__(*args, **kw)
 
         self.srcpad = gst.Pad(self.src_template)
+        self.srcpad.set_query_function(self._src_query)
         self.add_pad(self.srcpad)
 
 
-        self._drawer = ArrowDrawer(width=self.line_thickness)
+        self._drawer = ArrowDrawer(width=self.line_thickness,
+                                   color=self.INLIER_COLOR)
 
 
     def mux(self, buf, flow):
-        if flow is None:
+        if flow is None or is_scene_cut(flow):
             return self.srcpad.push(buf)
-        origins, ends = flow
+        # a transform sent by the finder without the points it comes from
+        # leaves us nothing to draw
+        points = flow_points(flow)
+        if points is None:
+            return self.srcpad.push(buf)
+        origins, ends = points
 
         img = img_of_buf(buf)
 
-        self._drawer.draw_arrows(img, origins, ends)
+        inliers = None
+        if self.show_outliers and len(origins) >= 4:
+            with flow_trace.span('ransac'):
+                _, inliers = transform_from_flow(flow)
+
+        if self.max_arrows > 0 and len(origins) > self.max_arrows:
+            step = int(math.ceil(len(origins) / float(self.max_arrows)))
+            origins = origins[::step]
+            ends = ends[::step]
+            if inliers is not None:
+                inliers = inliers[::step]
+
+        with flow_trace.span('draw'):
+            self._draw(img, origins, ends, inliers)
 
         new_buf = buf_of_img(img, bufmodel=buf)
 
-        return self.srcpad.push(new_buf)
+        with flow_trace.span('push'):
+            return self.srcpad.push(new_buf)
+
+    def _draw(self, img, origins, ends, inliers=None):
+        if inliers is not None:
+            self._drawer.draw_arrows(img, origins[inliers], ends[inliers],
+                                     self.INLIER_COLOR)
+            self._drawer.draw_arrows(img, origins[~inliers], ends[~inliers],
+                                     self.OUTLIER_COLOR)
+        else:
+            self._drawer.draw_arrows(img, origins, ends)
 
 
 gobject.type_register (OpticalFlowDrawer)
@@ -22,8 +22,11 @@ import gobject,gst
 import cPickle
 
 from cv_gst_util import *
+import flow_trace
 
-from cv_flow_finder import LucasKanadeFinder, SURFFinder
+import cv_flow_finder
+from cv_flow_finder import FrameChangeClassifier, SCENE_CUT, corner_flow, \
+                           transform_from_flow, flow_record
 
 
 class OpticalFlowFinder(gst.Element):
@@ -46,8 +49,9 @@ class OpticalFlowFinder(gst.Element):
     PICKLE_FORMAT = 2
 
     # Algorithms to chose from:
-    LUCAS_KANADE = 1
-    SURF = 2
+    LUCAS_KANADE = cv_flow_finder.LUCAS_KANADE
+    SURF = cv_flow_finder.SURF
+    PHASE_CORRELATION = cv_flow_finder.PHASE_CORRELATION
 
     corner_count = gobject.property(type=int,
                                  default=50,
@@ -70,11 +74,61 @@ class OpticalFlowFinder(gst.Element):
     epsilon = gobject.property(type=float,
                                     default=0.001,
                                     blurb='terminate when we reach that difference or smaller')
+    tile_rows = gobject.property(type=int,
+                                 default=1,
+                                 blurb='number of rows of tiles in which corners are detected in parallel, each tile getting its share of corner-count')
+    tile_columns = gobject.property(type=int,
+                                    default=1,
+                                    blurb='number of columns of tiles in which corners are detected in parallel, each tile getting its share of corner-count')
+    detection_threads = gobject.property(type=int,
+                                         default=0,
+                                         blurb='number of threads detecting corners in tiles, one per tile if 0')
+    motion_prior = gobject.property(type=int,
+                                    default=0,
+                                    blurb="""Lucas Kanade: how to guess where corners went before refining, which allows for fewer pyramid levels, a smaller window and fewer iterations:
+                                    0: no guess
+                                    1: extrapolate from the previous frame
+                                    2: coarse phase correlation""")
+    prior_downscale = gobject.property(type=int,
+                                       default=4,
+                                       blurb='factor by which frames are downscaled for the coarse phase correlation of motion-prior')
     algorithm = gobject.property(type=int,
                                  default=LUCAS_KANADE,
                                  blurb= """algorithm to use:
                                  %d: Lucas Kanade (discreet, fast, precise, not good for big changes between frames)
-                                 %d: SURF (Speeded Up Robust Feature, finds features, finds them again)""" % (LUCAS_KANADE, SURF))
+                                 %d: SURF (Speeded Up Robust Feature, finds features, finds them again)
+                                 %d: Phase correlation (no features, very fast, mostly for translations)""" % (LUCAS_KANADE, SURF, PHASE_CORRELATION))
+    phase_downscale = gobject.property(type=int,
+                                       default=1,
+                                       blurb='phase correlation: factor by which frames are downscaled before analysis')
+    log_polar = gobject.property(type=bool,
+                                 default=False,
+                                 blurb='phase correlation: also estimate rotation and scale with a log-polar transform (slower)')
+    guided_matching = gobject.property(type=bool,
+                                       default=False,
+                                       blurb='SURF: only compare features with those found near where the previous motion would move them, instead of searching the whole frame')
+    search_radius = gobject.property(type=int,
+                                     default=30,
+                                     minimum=1,
+                                     blurb='SURF: distance in pixels around the predicted position in which features are compared when guided-matching is set')
+    prune_outliers = gobject.property(type=bool,
+                                      default=False,
+                                      blurb='fit a homography to the flow with RANSAC, and stop tracking the points that do not agree with it')
+    compute_transform = gobject.property(type=bool,
+                                         default=False,
+                                         blurb='fit a homography to the flow with RANSAC, and send it with its number of inliers and a confidence instead of the flow')
+    include_points = gobject.property(type=bool,
+                                      default=False,
+                                      blurb='compute-transform: also send the flow and which points agree with the homography, e.g. for opticalflowdrawer')
+    change_detection = gobject.property(type=bool,
+                                        default=False,
+                                        blurb='compare thumbnails of consecutive frames to skip the analysis of static frames and detect scene cuts')
+    static_threshold = gobject.property(type=float,
+                                        default=1.,
+                                        blurb='change detection: mean grey level difference between thumbnails under which a frame is considered static')
+    cut_threshold = gobject.property(type=float,
+                                     default=.5,
+                                     blurb='change detection: histogram correlation under which a frame is considered to be after a scene cut')
 
 
     def __init__(self, *args, **kw):
@@ -85,55 +139,92 @@ class OpticalFlowFinder(gst.Element):
 
         self.sinkpad = gst.Pad(self.sink_template)
         self.sinkpad.set_chain_function(self._chain)
+        self.sinkpad.set_event_function(self._sink_event)
         self.add_pad(self.sinkpad)
 
         self._previous_img = None
         self._previous_blob = None
 
         self._finder = None
+        self._classifier = None
 
     def _chain(self, pad, buf):
-        img = img_of_buf(buf)
+        with flow_trace.frame(self.get_name(), buf):
+            flow = self._find_flow(img_of_buf(buf))
 
-        if self._previous_img is not None:
+            with flow_trace.span('pickle'):
+                pickled_flow = cPickle.dumps(flow, self.PICKLE_FORMAT)
+            new_buf = gst.Buffer(pickled_flow)
+            new_buf.stamp(buf)
+
+            with flow_trace.span('push'):
+                return self.srcpad.push(new_buf)
+
+    def _find_flow(self, img):
+        change = FrameChangeClassifier.NORMAL
+        if self._classifier is not None:
+            with flow_trace.span('classify'):
+                change = self._classifier.classify(img)
+
+        if self._previous_img is None:
+            flow, blob = None, None
+        elif change == FrameChangeClassifier.STATIC:
+            # nothing moved, we keep comparing with the last analysed frame
+            flow = corner_flow(img.shape, numpy.eye(3))
+            if self.compute_transform:
+                return flow_record(flow, numpy.eye(3), None,
+                                   self.include_points)
+            return flow
+        elif change == FrameChangeClassifier.CUT:
+            print "scene cut detected"
+            flow, blob = SCENE_CUT, None
+        else:
             flow, blob = self._finder.optical_flow_img(self._previous_img,
                                                        img,
                                                        self._previous_blob)
-        else:
-            flow, blob = None, None
+            transform, inliers = None, None
+            if (self.prune_outliers or self.compute_transform) \
+               and len(flow[0]) >= 4:
+                with flow_trace.span('ransac'):
+                    transform, inliers = transform_from_flow(flow)
+            if self.prune_outliers:
+                blob = self._finder.drop_outliers(blob, inliers)
+            if self.compute_transform:
+                flow = flow_record(flow, transform, inliers,
+                                   self.include_points)
         self._previous_img = img
         self._previous_blob = blob
+        return flow
 
-        pickled_flow = cPickle.dumps(flow, self.PICKLE_FORMAT)
-        new_buf = gst.Buffer(pickled_flow)
-        new_buf.stamp(buf)
-
-        return self.srcpad.push(new_buf)
+    def _sink_event(self, pad, event):
+        if event.type == gst.EVENT_EOS:
+            flow_trace.flush()
+        elif event.type == gst.EVENT_FLUSH_STOP:
+            # after a seek, the next frame has nothing to do with the last one
+            self._previous_img = None
+            self._previous_blob = None
+            if self._classifier is not None:
+                self._classifier.reset()
+        return pad.event_default(event)
 
     def do_change_state(self, state_change):
         if state_change == gst.STATE_CHANGE_NULL_TO_READY:
             self._finder = self._create_finder()
+            if self.change_detection:
+                self._classifier = FrameChangeClassifier(self.static_threshold,
+                                                         self.cut_threshold)
         elif state_change == gst.STATE_CHANGE_READY_TO_NULL:
+            if self._finder is not None:
+                self._finder.close()
             self._finder = None
+            self._classifier = None
             self._previous_img = None
             self._previous_blob = None
 
         return gst.Element.do_change_state(self, state_change)
 
     def _create_finder(self):
-        if self.algorithm == self.LUCAS_KANADE:
-            finder = LucasKanadeFinder(self.corner_count,
-                                             self.corner_quality_level,
-                                             self.corner_min_distance,
-                                             self.win_size,
-                                             self.pyramid_level,
-                                             self.max_iterations,
-                                             self.epsilon)
-        elif self.algorithm == self.SURF:
-            finder = SURFFinder()
-        else:
-            raise ValueError("Unknown algorithm")
-        return finder
+        return cv_flow_finder.create_finder(self.algorithm, self)
 
 
 gobject.type_register (OpticalFlowFinder)
@@ -20,14 +20,29 @@
 import gst
 
 import cPickle
+import threading
+import time
 from collections import deque
 
+import flow_trace
+
 
 class OpticalFlowMuxer(gst.Element):
     """
     Base class for "muxers" of an optical flow stream and another stream having
     the same timestamps.
     When subclassing, you should implement mux and redefine main_sink_template
+
+    Buffers from both sink pads are matched by timestamp. A main buffer whose
+    flow buffer was lost is given to mux with a flow of None, and flow buffers
+    with no main buffer are dropped. The queues of buffers waiting for their
+    counterpart are bounded by max_queue_size and max_queue_time; what happens
+    when they are full depends on overflow_policy. Subclasses can expose these
+    as element properties by declaring gobject properties with the same names.
+    The time buffers wait for their counterpart can be exposed as a read-only
+    queue_latency property with _get_queue_latency as getter, and is added to
+    the latency reported upstream if _src_query is set as query function of
+    the source pad.
     """
 
     flow_sink_template = gst.PadTemplate ("flowsink",
@@ -38,6 +53,17 @@ class OpticalFlowMuxer(gst.Element):
     # should be defined as a proper pad template in the subclass
     main_sink_template = None
 
+    # overflow policies:
+    DROP_OLDEST = 0
+    BLOCK = 1
+
+    # maximum number of buffers waiting on each sink pad, no limit if 0
+    max_queue_size = 30
+    # maximum difference between the timestamps of the oldest and newest
+    # buffers waiting on each sink pad, no limit if 0
+    max_queue_time = 0
+    overflow_policy = DROP_OLDEST
+
     def __init__(self):
         gst.Element.__init__(self)
 
@@ -48,44 +74,252 @@ class OpticalFlowMuxer(gst.Element):
 
         self.main_sink_pad = gst.Pad(self.main_sink_template)
         self.main_sink_pad.set_chain_function(self._chain)
+        self.main_sink_pad.set_event_function(self._main_event)
         self.add_pad(self.main_sink_pad)
 
-        # FIXME: shouldn't we just use gstreamer queues outside of the elemnt?
+        # both sink pads are usually driven by different streaming threads
+        self._queue_changed = threading.Condition(threading.Lock())
+
+        # (buffer, arrival time) pairs
         self._pending_flow = deque()
         self._pending_main = deque()
 
+        # held while matching and muxing buffers, so that they go out in
+        # order, but never with self._queue_changed held: pushing downstream
+        # can block until a flush, and flushes need self._queue_changed
+        self._mux_lock = threading.Lock()
+
+        self._main_flushing = False
+        self._flow_flushing = False
+        self._main_eos = False
+        self._flow_eos = False
+
+        # how long (in ns) the last muxed buffer waited for its counterpart,
+        # and the longest wait, added to the latency reported upstream
+        self._queue_latency = 0
+        self._max_queue_latency = 0
+
     def mux(self, buf, flow):
         raise NotImplementedError("This method needs to be implemented in a subclass")
 
+    def reset(self):
+        # called when the main stream is flushed, usually because of a seek:
+        # the next frame does not follow the last one
+        pass
+
+    def _get_queue_latency(self):
+        # getter for the read-only queue-latency property of subclasses
+        return self._queue_latency
+
+    def _src_query(self, pad, query):
+        # subclasses should set it as query function of their source pad
+        if query.type != gst.QUERY_LATENCY:
+            return pad.query_default(query)
+        peer = self.main_sink_pad.get_peer()
+        if peer is None or not peer.query(query):
+            return False
+        live, min_latency, max_latency = query.parse_latency()
+        min_latency += self._max_queue_latency
+        if max_latency != gst.CLOCK_TIME_NONE:
+            max_latency += self._max_queue_latency
+        query.set_latency(live, min_latency, max_latency)
+        return True
+
     def _chain(self, pad, buf):
-        if pad == self.flow_sink_pad:
-            self._pending_flow.append(buf)
-        else: # self.main_sink_pad
-            self._pending_main.append(buf)
+        with self._queue_changed:
+            if pad == self.flow_sink_pad:
+                if self._flow_flushing:
+                    return gst.FLOW_WRONG_STATE
+                if self._main_eos:
+                    return gst.FLOW_UNEXPECTED
+                queue = self._pending_flow
+            else: # self.main_sink_pad
+                if self._main_flushing:
+                    return gst.FLOW_WRONG_STATE
+                queue = self._pending_main
+
+            if self.overflow_policy == self.BLOCK:
+                while self._is_full(queue, buf) and not self._is_flushing(pad):
+                    self._queue_changed.wait()
+                if self._is_flushing(pad):
+                    return gst.FLOW_WRONG_STATE
+                if pad == self.flow_sink_pad and self._main_eos:
+                    return gst.FLOW_UNEXPECTED
+                queue.append((buf, time.time()))
+            else:
+                queue.append((buf, time.time()))
+                while self._is_full(queue):
+                    dropped, _ = queue.popleft()
+                    print "%s queue full, dropping buffer %.4f" \
+                        % (pad.get_name(), dropped.timestamp / float(gst.SECOND))
+
         return self._try_mux()
 
+    def _is_full(self, queue, new_buf=None):
+        # whether queue is full, or would be if new_buf was added
+        size = len(queue)
+        if new_buf is not None:
+            size += 1
+        if self.max_queue_size > 0 and size > self.max_queue_size:
+            return True
+        if self.max_queue_time > 0 and size > 1:
+            if new_buf is None:
+                new_buf, _ = queue[-1]
+            oldest, _ = queue[0]
+            if self._has_timestamp(oldest) and self._has_timestamp(new_buf):
+                return new_buf.timestamp - oldest.timestamp > self.max_queue_time
+        return False
+
+    def _is_flushing(self, pad):
+        if pad == self.flow_sink_pad:
+            return self._flow_flushing
+        return self._main_flushing
+
+    def _has_timestamp(self, buf):
+        return buf.timestamp != gst.CLOCK_TIME_NONE
+
+    def _is_before(self, buf0, buf1):
+        # If one of them has no timestamp, we can only match them in order
+        if not (self._has_timestamp(buf0) and self._has_timestamp(buf1)):
+            return False
+        return buf0.timestamp < buf1.timestamp
+
     def _try_mux(self):
-        if self._pending_flow and self._pending_main:
-            flow_buf = self._pending_flow.popleft()
-            flow = cPickle.loads(flow_buf.data)
-            buf = self._pending_main.popleft()
-            if buf.timestamp == flow_buf.timestamp:
-                return self.mux(buf, flow)
-            else:
-                print "All going wrong!"
-                return gst.FLOW_ERROR
+        # needs to be called without self._queue_changed held
+        ret = gst.FLOW_OK
+        with self._mux_lock:
+            while True:
+                with self._queue_changed:
+                    match = self._pop_match()
+                if match is None:
+                    break
+                buf, flow_buf, arrival = match
+
+                flow = None
+                if flow_buf is not None:
+                    with flow_trace.span('unpickle'):
+                        flow = cPickle.loads(flow_buf.data)
+                now = time.time()
+                self._queue_latency = int((now - arrival) * gst.SECOND)
+                self._max_queue_latency = max(self._max_queue_latency,
+                                              self._queue_latency)
+                flow_trace.async_span('wait', self.get_name(), buf.timestamp,
+                                      arrival, now)
+                with flow_trace.frame(self.get_name(), buf):
+                    ret = self.mux(buf, flow)
+                if ret != gst.FLOW_OK:
+                    break
+        return ret
+
+    def _pop_match(self):
+        # needs to be called with self._queue_changed held. Returns the next
+        # main buffer that can be muxed, with its flow buffer (or None) and
+        # the time at which the first of them arrived, or None.
+        while self._pending_main and (self._pending_flow or self._flow_eos):
+            buf, arrival = self._pending_main[0]
+            flow_buf = None
+            if self._pending_flow:
+                candidate, flow_arrival = self._pending_flow[0]
+                if self._is_before(candidate, buf):
+                    print "no frame for flow buffer %.4f, dropping it" \
+                        % (candidate.timestamp / float(gst.SECOND))
+                    self._pending_flow.popleft()
+                    self._queue_changed.notify_all()
+                    continue
+                if self._is_before(buf, candidate):
+                    print "no flow for frame %.4f" \
+                        % (buf.timestamp / float(gst.SECOND))
+                else:
+                    self._pending_flow.popleft()
+                    flow_buf = candidate
+                    arrival = min(arrival, flow_arrival)
+            self._pending_main.popleft()
+            self._queue_changed.notify_all()
+            return buf, flow_buf, arrival
 
-        return gst.FLOW_OK
+        if self._main_eos and self._pending_flow:
+            self._pending_flow.clear()
+            self._queue_changed.notify_all()
+        return None
+
+    def _main_event(self, pad, event):
+        if event.type == gst.EVENT_FLUSH_START:
+            # forward it first, so that a push blocked downstream returns
+            ret = pad.event_default(event)
+            with self._queue_changed:
+                self._main_flushing = True
+                self._pending_main.clear()
+                self._queue_changed.notify_all()
+            return ret
+        elif event.type == gst.EVENT_FLUSH_STOP:
+            # not while a buffer from before the flush is being muxed
+            with self._mux_lock:
+                self.reset()
+            with self._queue_changed:
+                self._main_flushing = False
+                self._main_eos = False
+        elif event.type == gst.EVENT_EOS:
+            # let the flow branch catch up before forwarding EOS
+            with self._queue_changed:
+                while self._pending_main and not self._flow_eos \
+                                         and not self._main_flushing:
+                    self._queue_changed.wait()
+                self._main_eos = True
+            self._try_mux()
+            flow_trace.flush()
+        return pad.event_default(event)
 
     def _flow_event(self, pad, event):
         # We just drop all new segment events from the flow pad. We assume they
         # are only duplicates of those we got on main_sink_pad (which are
-        # automatically forwarded since we have no event handling function)
+        # forwarded by _main_event)
         # This might be dirty but seems to be working.
+        # Flushes and EOS are only used to manage the flow queue, the main pad
+        # gets its own.
         if event.type == gst.EVENT_NEWSEGMENT:
             return True
+        elif event.type == gst.EVENT_FLUSH_START:
+            with self._queue_changed:
+                self._flow_flushing = True
+                self._pending_flow.clear()
+                self._queue_changed.notify_all()
+            return True
+        elif event.type == gst.EVENT_FLUSH_STOP:
+            with self._queue_changed:
+                self._flow_flushing = False
+                self._flow_eos = False
+            return True
+        elif event.type == gst.EVENT_EOS:
+            with self._queue_changed:
+                self._flow_eos = True
+                self._queue_changed.notify_all()
+            # frames still waiting will not get any flow
+            self._try_mux()
+            return True
         return False
 
+    def do_change_state(self, state_change):
+        if state_change == gst.STATE_CHANGE_PAUSED_TO_READY:
+            # chains blocked waiting for room in the queues return
+            with self._queue_changed:
+                self._main_flushing = True
+                self._flow_flushing = True
+                self._queue_changed.notify_all()
+
+        ret = gst.Element.do_change_state(self, state_change)
+
+        if state_change == gst.STATE_CHANGE_PAUSED_TO_READY:
+            with self._queue_changed:
+                self._pending_main.clear()
+                self._pending_flow.clear()
+                self._main_flushing = False
+                self._flow_flushing = False
+                self._main_eos = False
+                self._flow_eos = False
+                self._queue_latency = 0
+                self._max_queue_latency = 0
+        return ret
+
 
 class TestFlowMuxer(OpticalFlowMuxer):
     __gstdetails__ = ("Optical flow muxer",
@@ -108,6 +342,7 @@ class TestFlowMuxer(OpticalFlowMuxer):
         super(TestFlowMuxer, self).__init__(*args, **kw)
 
         self.srcpad = gst.Pad(self.src_template)
+        self.srcpad.set_query_function(self._src_query)
         self.add_pad(self.srcpad)
 
     def mux(self, buf, flow):
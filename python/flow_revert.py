@@ -20,7 +20,12 @@
 import gst, gobject
 
 from flow_muxer import OpticalFlowMuxer
+from cv_flow_finder import is_scene_cut, transform_from_flow, flow_points, \
+                           grid_flow, PhaseCorrelationFinder
 from cv_gst_util import *
+import flow_trace
+from lens_correction import create_lens_correction
+from transform_cache import create_transform_cache
 
 
 class OpticalFlowRevert(OpticalFlowMuxer):
@@ -43,56 +48,265 @@ class OpticalFlowRevert(OpticalFlowMuxer):
     demo_mode = gobject.property(type=bool,
                                  default=False,
                                  blurb="Output a mix of the unstabilised and stabilised streams")
+    max_queue_size = gobject.property(type=int,
+                                      default=OpticalFlowMuxer.max_queue_size,
+                                      blurb='maximum number of buffers waiting for their counterpart on each sink pad, no limit if 0')
+    max_queue_time = gobject.property(type=gobject.TYPE_UINT64,
+                                      default=OpticalFlowMuxer.max_queue_time,
+                                      blurb='maximum timestamp difference (in ns) between buffers waiting on a sink pad, no limit if 0')
+    overflow_policy = gobject.property(type=int,
+                                       default=OpticalFlowMuxer.overflow_policy,
+                                       blurb="""what to do when a sink pad has too many buffers waiting:
+                                       %d: drop the oldest one
+                                       %d: block until there is room""" % (OpticalFlowMuxer.DROP_OLDEST, OpticalFlowMuxer.BLOCK))
+    queue_latency = gobject.property(type=gobject.TYPE_UINT64,
+                                     getter=OpticalFlowMuxer._get_queue_latency,
+                                     blurb='how long (in ns) the last frame waited for its flow or the other way round, read-only')
+    transform_cache = gobject.property(type=str,
+                                       default='',
+                                       blurb='file where the transform of each frame is kept, so that it can be found again after a seek or in a later run; only kept in memory if empty and cache-size is set')
+    cache_size = gobject.property(type=int,
+                                  default=0,
+                                  minimum=0,
+                                  blurb='number of frames whose transform is kept to be found again after a seek, the least recently used ones being forgotten first; no limit if 0 and transform-cache is set, nothing kept if both are unset')
+    lens_fx = gobject.property(type=float,
+                               default=0.,
+                               blurb='focal length of the camera along x, in pixels; if not 0, lens distortion is removed in the same pass as the stabilisation')
+    lens_fy = gobject.property(type=float,
+                               default=0.,
+                               blurb='focal length of the camera along y, in pixels; the same as lens-fx if 0')
+    lens_cx = gobject.property(type=float,
+                               default=-1.,
+                               blurb='x coordinate of the optical centre, in pixels; centre of the frame if negative')
+    lens_cy = gobject.property(type=float,
+                               default=-1.,
+                               blurb='y coordinate of the optical centre, in pixels; centre of the frame if negative')
+    lens_k1 = gobject.property(type=float,
+                               default=0.,
+                               blurb='first radial distortion coefficient')
+    lens_k2 = gobject.property(type=float,
+                               default=0.,
+                               blurb='second radial distortion coefficient')
+    lens_k3 = gobject.property(type=float,
+                               default=0.,
+                               blurb='third radial distortion coefficient')
+    lens_p1 = gobject.property(type=float,
+                               default=0.,
+                               blurb='first tangential distortion coefficient')
+    lens_p2 = gobject.property(type=float,
+                               default=0.,
+                               blurb='second tangential distortion coefficient')
+    crop_margin = gobject.property(type=float,
+                                   default=0.,
+                                   minimum=0.,
+                                   maximum=.49,
+                                   blurb='if not 0, only output the centre of the stabilised frames, leaving out that fraction of their width and height on each side, so that the parts not covered by the frame after the transform are rarely seen')
+    output_width = gobject.property(type=int,
+                                    default=0,
+                                    blurb='width to which the output is scaled, in the same pass as the stabilisation; that of the input if 0 (and output-height is 0 too), or keeping the aspect ratio if only output-height is set')
+    output_height = gobject.property(type=int,
+                                     default=0,
+                                     blurb='height to which the output is scaled, in the same pass as the stabilisation; that of the input if 0 (and output-width is 0 too), or keeping the aspect ratio if only output-width is set')
 
     def __init__(self, *args, **kw):
         super(OpticalFlowRevert, self).__init__(*args, **kw)
 
         self.srcpad = gst.Pad(self.src_template)
+        self.srcpad.set_query_function(self._src_query)
         self.add_pad(self.srcpad)
 
         self._last_output_img = None
-        self._reference_transform = numpy.asarray([[1., 0., 0.],
-                                                   [0., 1., 0.],
-                                                   [0., 0., 1.]],
-                                                   dtype=numpy.float128)
+        # set with the first frame
+        self._reference_transform = None
+        self._cache = None
+        self._lens = None
+        # output (width, height) and transform from output to frame pixels,
+        # when cropping or scaling
+        self._viewport = None
+        # last input frame, to estimate the motion of a frame whose flow was
+        # lost
+        self._last_input_img = None
+        self._correlator = None
 
-    def mux(self, buf, flow):
-        if flow is None:
-            self._last_output_img = img_of_buf(buf)
-            return self.srcpad.push(buf)
+    # factor by which frames are downscaled to estimate a missing motion
+    GAP_DOWNSCALE = 2
 
-        origins, ends = flow
+    def reset(self):
+        self._last_output_img = None
+        self._reference_transform = None
+        self._last_input_img = None
 
-        transform, mask = cv2.findHomography(origins, ends,
-                                             method=cv2.RANSAC,
-                                             ransacReprojThreshold=3)
+    def mux(self, buf, flow):
+        img = img_of_buf(buf)
+        if self._lens is None:
+            self._lens = create_lens_correction(self, img.shape)
+        if self._viewport is None and self._uses_viewport():
+            self._viewport = viewport_transform(img.shape, self.crop_margin,
+                                                self.output_width,
+                                                self.output_height)
 
-        # we accumulate the transformations, so that we apply a transformation
-        # relative to the first frame
-        self._reference_transform = transform.dot(self._reference_transform)
+        if is_scene_cut(flow) or (self._reference_transform is None
+                                  and not self._restore(buf)):
+            # first frame, or first frame of a new scene: that is our new
+            # reference
+            self._reference_transform = numpy.eye(3, dtype=numpy.float128)
+            self._remember(buf)
+            self._last_input_img = img
+            if self._lens is None and self._viewport is None:
+                self._last_output_img = img
+                return self.srcpad.push(buf)
+            # it still needs to be undistorted or cropped
+            self._last_output_img = None
+        else:
+            transform = None
+            if flow is not None:
+                if self._lens is not None and flow_points(flow) is None:
+                    self._missing_points()
+                    return gst.FLOW_ERROR
+                transform = self._transform_from_flow(flow)
+            if transform is None:
+                # the flow for this frame got lost or gave nothing. Keeping
+                # the last transform would leave out the motion of this frame
+                # for all the next ones, we estimate it instead.
+                transform = self._estimate_transform(buf, img)
 
-        img = img_of_buf(buf)
-        new_img = self._last_output_img.copy()
+            # we accumulate the transformations, so that we apply a
+            # transformation relative to the first frame
+            if transform is not None:
+                self._reference_transform = transform.dot(self._reference_transform)
+        self._remember(buf)
+        self._last_input_img = img
 
-        new_img = cv2.warpPerspective(img,
-                                      numpy.asarray(self._reference_transform,
-                                                    dtype=numpy.float64),
-                                      (img.shape[1], img.shape[0]),
-                                      dst=new_img,
-                                      flags=cv2.WARP_INVERSE_MAP + cv2.INTER_CUBIC,
-                                      borderMode=cv2.BORDER_TRANSPARENT)
+        if self._viewport is not None:
+            # nothing to keep from the last output, the viewport is always
+            # covered
+            new_img = self._warp_viewport(img)
+        else:
+            background = self._last_output_img
+            if background is None and self._lens is None:
+                # first frame after a seek
+                background = img
+            new_img = self._warp(img, background)
+            self._last_output_img = new_img
 
-        self._last_output_img = new_img
         if not self.demo_mode:
             new_buf = buf_of_img(new_img, bufmodel=buf)
-            return self.srcpad.push(new_buf)
+            with flow_trace.span('push'):
+                return self.srcpad.push(new_buf)
         else:
-            demo_img = img.copy()
-            width = img.shape[1]
+            if img.shape != new_img.shape:
+                demo_img = cv2.resize(img, (new_img.shape[1], new_img.shape[0]))
+            else:
+                demo_img = img.copy()
+            width = new_img.shape[1]
             mid_width = width/2
             demo_img[:, mid_width:] = new_img[:, mid_width:]
             new_buf = buf_of_img(demo_img, bufmodel=buf)
-            return self.srcpad.push(new_buf)
+            with flow_trace.span('push'):
+                return self.srcpad.push(new_buf)
+
+    def _transform_from_flow(self, flow):
+        points = flow_points(flow)
+        if self._lens is not None and points is not None:
+            # we warp undistorted frames, so we need the homography between
+            # undistorted frames
+            points0, points1 = points
+            flow = (self._lens.undistort_points(points0),
+                    self._lens.undistort_points(points1))
+        # the finder may have found the transform already
+        with flow_trace.span('ransac'):
+            transform, inliers = transform_from_flow(flow)
+        return transform
+
+    def _estimate_transform(self, buf, img):
+        # motion since the last input frame, from a coarse phase correlation
+        if self._last_input_img is None \
+           or self._last_input_img.shape != img.shape:
+            return None
+        if self._correlator is None:
+            self._correlator = PhaseCorrelationFinder(self.GAP_DOWNSCALE)
+        print "no flow for frame %.4f, estimating its motion" \
+            % (buf.timestamp / float(gst.SECOND))
+        with flow_trace.span('gap'):
+            transform, _ = self._correlator.find_transform(
+                    gray_scale(self._last_input_img), gray_scale(img))
+        # the transform is between distorted frames, spread over the whole
+        # frame it is still good enough once undistorted
+        return self._transform_from_flow(grid_flow(img.shape, transform))
+
+    def _missing_points(self):
+        # the finder only sent the homography it found between the distorted
+        # frames, which does not hold once they are undistorted
+        error = gst.GError(gst.STREAM_ERROR, gst.STREAM_ERROR_FAILED,
+                           "lens-fx is set but the flow has no points: set "
+                           "include-points on the finder when it computes "
+                           "the transform")
+        self.post_message(gst.message_new_error(self, error, ''))
+
+    def _warp(self, img, background):
+        # parts of the frame that img does not cover after the transform are
+        # taken from background (from the borders of img if None)
+        transform = numpy.asarray(self._reference_transform,
+                                  dtype=numpy.float64)
+        if self._lens is not None:
+            return self._lens.warp(img, transform, background, cv2.INTER_CUBIC)
+
+        with flow_trace.span('warp'):
+            return cv2.warpPerspective(img, transform,
+                                       (img.shape[1], img.shape[0]),
+                                       dst=background.copy(),
+                                       flags=cv2.WARP_INVERSE_MAP + cv2.INTER_CUBIC,
+                                       borderMode=cv2.BORDER_TRANSPARENT)
+
+    def _uses_viewport(self):
+        return self.crop_margin > 0 or self.output_width > 0 \
+               or self.output_height > 0
+
+    def _warp_viewport(self, img):
+        # only computes the pixels of the viewport, from the nearest border of
+        # the frame when it does not cover them
+        size, viewport = self._viewport
+        transform = numpy.asarray(self._reference_transform,
+                                  dtype=numpy.float64).dot(viewport)
+        if self._lens is not None:
+            return self._lens.warp(img, transform, None, cv2.INTER_CUBIC, size)
+
+        with flow_trace.span('warp'):
+            return cv2.warpPerspective(img, transform, size,
+                                       flags=cv2.WARP_INVERSE_MAP + cv2.INTER_CUBIC,
+                                       borderMode=cv2.BORDER_REPLICATE)
+
+    def _restore(self, buf):
+        # after a seek, go on with the transform we had for that frame, if we
+        # saw it already
+        if self._cache is None:
+            return False
+        transform = self._cache.lookup_buffer(buf)
+        if transform is None:
+            return False
+        print "restoring transform for frame %.4f" \
+            % (buf.timestamp / float(gst.SECOND))
+        self._reference_transform = transform
+        return True
+
+    def _remember(self, buf):
+        if self._cache is not None:
+            self._cache.add(buf.timestamp, self._reference_transform)
+
+    def do_change_state(self, state_change):
+        if state_change == gst.STATE_CHANGE_NULL_TO_READY:
+            self._cache = create_transform_cache(self)
+        elif state_change == gst.STATE_CHANGE_PAUSED_TO_READY:
+            if self._cache is not None:
+                self._cache.save()
+        elif state_change == gst.STATE_CHANGE_READY_TO_NULL:
+            self._cache = None
+            self._lens = None
+            self._viewport = None
+            self._correlator = None
+            self._last_input_img = None
+
+        return OpticalFlowMuxer.do_change_state(self, state_change)
 
 
 gobject.type_register (OpticalFlowRevert)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Igalia S.L. and Guillaume Emont
+# Contact: Guilaume Emont <guijemont@igalia.com>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Per-frame tracing of the processing stages of the elements.
+
+Tracing is enabled by setting the GST_STABILIZER_TRACE environment variable to
+the path of the file where the trace should be written. The trace is written
+in the Chrome trace event format (load it in chrome://tracing) every time an
+element gets EOS, and whenever Tracer.FLUSH_EVENTS events are waiting to be
+written.
+
+Elements wrap the processing of each buffer in frame(), and each stage in
+span(); when tracing is disabled, both do nothing.
+"""
+
+import json
+import os
+import thread
+import threading
+import time
+from contextlib import contextmanager
+
+TRACE_ENV = 'GST_STABILIZER_TRACE'
+
+
+class Tracer(object):
+    # number of events kept in memory before they are written
+    FLUSH_EVENTS = 10000
+
+    def __init__(self, path, *args, **kw):
+        super(Tracer, self).__init__(*args, **kw)
+        self.path = path
+        self._pid = os.getpid()
+        self._events = []
+        self._lock = threading.Lock()
+        # several elements can flush from their own streaming thread
+        self._write_lock = threading.Lock()
+        # number of events already in the file
+        self._written = 0
+        # the frame currently processed by each thread
+        self._local = threading.local()
+
+    def _now(self):
+        # trace event timestamps are in microseconds
+        return time.time() * 1e6
+
+    def _args(self, stream=None, timestamp=None):
+        if stream is None:
+            stream, timestamp = getattr(self._local, 'frame', (None, None))
+        if stream is None:
+            return {}
+        return {'stream': stream, 'timestamp': timestamp}
+
+    def _add(self, phase, name, ts, args, **extra):
+        event = {'name': name, 'cat': 'stabilizer', 'ph': phase, 'ts': ts,
+                 'pid': self._pid, 'tid': thread.get_ident(), 'args': args}
+        event.update(extra)
+        with self._lock:
+            self._events.append(event)
+            full = len(self._events) >= self.FLUSH_EVENTS
+        if full:
+            self.flush()
+
+    @contextmanager
+    def frame(self, stream, buf):
+        # processing of buf by the element stream, stages traced from the same
+        # thread until the end of it are tagged with the buffer timestamp
+        previous = getattr(self._local, 'frame', None)
+        self._local.frame = (stream, buf.timestamp)
+        try:
+            with self.span(stream):
+                yield
+        finally:
+            self._local.frame = previous
+
+    @contextmanager
+    def span(self, name):
+        args = self._args()
+        self._add('B', name, self._now(), args)
+        try:
+            yield
+        finally:
+            self._add('E', name, self._now(), args)
+
+    def async_span(self, name, stream, timestamp, start, end):
+        # for spans that do not nest in what the current thread does, such as
+        # a buffer waiting in a queue. start and end are given in seconds, as
+        # returned by time.time()
+        args = self._args(stream, timestamp)
+        span_id = '%s-%s' % (stream, timestamp)
+        self._add('b', name, start * 1e6, args, id=span_id)
+        self._add('e', name, end * 1e6, args, id=span_id)
+
+    def flush(self):
+        # only the events since the last flush are written: the trace is a
+        # JSON array of events, closed after each flush, and reopened by the
+        # next one to append to it
+        with self._write_lock:
+            with self._lock:
+                events, self._events = self._events, []
+            if not events and self._written:
+                return
+            data = ',\n'.join(json.dumps(event) for event in events)
+            if not self._written:
+                with open(self.path, 'wb') as trace_file:
+                    trace_file.write('[\n%s\n]\n' % data)
+            else:
+                with open(self.path, 'rb+') as trace_file:
+                    # overwrite the closing "]\n"
+                    trace_file.seek(-2, os.SEEK_END)
+                    trace_file.write(',\n%s\n]\n' % data)
+            self._written += len(events)
+
+
+class _NullContext(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_null_context = _NullContext()
+
+_tracer = None
+if os.environ.get(TRACE_ENV):
+    _tracer = Tracer(os.environ[TRACE_ENV])
+
+
+def get_tracer():
+    """
+    Returns the process wide Tracer, or None if tracing is disabled.
+    """
+    return _tracer
+
+def frame(stream, buf):
+    if _tracer is None:
+        return _null_context
+    return _tracer.frame(stream, buf)
+
+def span(name):
+    if _tracer is None:
+        return _null_context
+    return _tracer.span(name)
+
+def async_span(name, stream, timestamp, start, end):
+    if _tracer is not None:
+        _tracer.async_span(name, stream, timestamp, start, end)
+
+def flush():
+    if _tracer is not None:
+        _tracer.flush()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Igalia S.L. and Guillaume Emont
+# Contact: Guilaume Emont <guijemont@igalia.com>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from cv_gst_util import *
+import flow_trace
+
+
+class LensCorrection(object):
+    """
+    Removes the lens distortion of frames in the same pass as their
+    stabilisation.
+    The undistortion map, giving for each pixel of the undistorted frame where
+    it is in the distorted frame, is computed once per frame size. For each
+    frame, that map is sent through the stabilisation homography, and the
+    frame is resampled only once, with the resulting map.
+    Homographies are expected to be between undistorted frames, see
+    undistort_points().
+    """
+    # where the map points for pixels that come from outside of the frame,
+    # when there is a background for them
+    OUTSIDE = -1000.
+
+    def __init__(self, camera_matrix, distortion, *args, **kw):
+        super(LensCorrection, self).__init__(*args, **kw)
+        self.camera_matrix = numpy.asarray(camera_matrix, dtype=numpy.float64)
+        self.distortion = numpy.asarray(distortion, dtype=numpy.float64)
+        self._map = None
+        # as big as the map, warped to know which pixels come from the frame
+        self._ones = None
+
+    def undistort_points(self, points):
+        """
+        Returns where points of the distorted frame are in the undistorted
+        one.
+        """
+        points = numpy.asarray(points, dtype=numpy.float32).reshape((-1, 1, 2))
+        if not len(points):
+            return points.reshape((0, 2))
+        undistorted = cv2.undistortPoints(points, self.camera_matrix,
+                                          self.distortion,
+                                          P=self.camera_matrix)
+        return undistorted.reshape((-1, 2))
+
+    def warp(self, img, transform, background=None, interpolation=None,
+             size=None):
+        """
+        Returns img undistorted, then transformed like warpPerspective would
+        with WARP_INVERSE_MAP into an image of the given size (that of img by
+        default). Pixels that do not come from img are taken from background,
+        or from the closest border of img if it is None.
+        """
+        if interpolation is None:
+            interpolation = cv2.INTER_LINEAR
+        height, width = img.shape[:2]
+        if size is None:
+            size = (width, height)
+        if self._map is None or self._map.shape[:2] != (height, width):
+            with flow_trace.span('undistort map'):
+                self._map, _ = cv2.initUndistortRectifyMap(
+                                    self.camera_matrix, self.distortion,
+                                    numpy.eye(3), self.camera_matrix,
+                                    (width, height), cv2.CV_32FC2)
+                self._ones = numpy.ones((height, width), dtype=numpy.uint8)
+
+        transform = numpy.asarray(transform, dtype=numpy.float64)
+        with flow_trace.span('warp'):
+            # the map is smooth, interpolating it linearly is good enough
+            warped_map = cv2.warpPerspective(self._map, transform, size,
+                                             flags=cv2.WARP_INVERSE_MAP + cv2.INTER_LINEAR,
+                                             borderMode=cv2.BORDER_REPLICATE)
+            if background is None:
+                return cv2.remap(img, warped_map, None, interpolation,
+                                 borderMode=cv2.BORDER_REPLICATE)
+
+            # an outside value in the map would be blended with the real
+            # coordinates next to it, making up coordinates inside the
+            # frame: pixels out of the map are found separately
+            inside = cv2.warpPerspective(self._ones, transform, size,
+                                         flags=cv2.WARP_INVERSE_MAP + cv2.INTER_NEAREST,
+                                         borderMode=cv2.BORDER_CONSTANT,
+                                         borderValue=0)
+            warped_map[inside == 0] = self.OUTSIDE
+            return cv2.remap(img, warped_map, None, interpolation,
+                             dst=background.copy(),
+                             borderMode=cv2.BORDER_TRANSPARENT)
+
+
+def create_lens_correction(element, shape):
+    """
+    Returns a LensCorrection configured from the lens-* properties of element,
+    for frames of the given shape, or None if no lens correction was asked
+    for.
+    """
+    if element.lens_fx <= 0:
+        return None
+    height, width = shape[:2]
+    fy = element.lens_fy
+    if fy <= 0:
+        fy = element.lens_fx
+    cx = element.lens_cx
+    if cx < 0:
+        cx = (width - 1) / 2.
+    cy = element.lens_cy
+    if cy < 0:
+        cy = (height - 1) / 2.
+    camera_matrix = [[element.lens_fx, 0., cx],
+                     [0., fy, cy],
+                     [0., 0., 1.]]
+    distortion = [element.lens_k1, element.lens_k2,
+                  element.lens_p1, element.lens_p2,
+                  element.lens_k3]
+    return LensCorrection(camera_matrix, distortion)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Igalia S.L. and Guillaume Emont
+# Contact: Guilaume Emont <guijemont@igalia.com>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import bisect
+import cPickle
+import os
+from collections import OrderedDict
+
+import gst
+
+
+class TransformCache(object):
+    """
+    Index from buffer timestamps to the transform that was applied to the
+    frame, so that after a seek the elements can go on from the right
+    transform instead of starting over, without analysing again the frames
+    before the seek position.
+    If path is given, the index is loaded from there if the file exists, and
+    save() writes it there. If max_size is not 0, only the transforms of the
+    max_size frames most recently added or looked up are kept, once up to
+    TRIM_SLACK times more have accumulated.
+    """
+    PICKLE_FORMAT = 2
+    # dropping transforms means copying the whole index, so we let it grow
+    # by that fraction of max_size before dropping them all at once
+    TRIM_SLACK = .25
+
+    def __init__(self, path=None, max_size=0, *args, **kw):
+        super(TransformCache, self).__init__(*args, **kw)
+        self.path = path
+        self.max_size = max_size
+        # sorted, with self._transforms[i] being the transform for
+        # self._timestamps[i]
+        self._timestamps = []
+        self._transforms = []
+        # the same timestamps, least recently used first
+        self._recent = OrderedDict()
+
+        if path and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self._timestamps)
+
+    def add(self, timestamp, transform):
+        index = bisect.bisect_left(self._timestamps, timestamp)
+        if index < len(self._timestamps) \
+           and self._timestamps[index] == timestamp:
+            self._transforms[index] = transform
+        else:
+            # usually appending, as we mostly see frames in order
+            self._timestamps.insert(index, timestamp)
+            self._transforms.insert(index, transform)
+        self._use(timestamp)
+        self._trim()
+
+    def lookup(self, timestamp, tolerance=0):
+        """
+        Returns the transform of the last frame at or before timestamp, if it
+        is no more than tolerance before it, and None otherwise.
+        """
+        index = bisect.bisect_right(self._timestamps, timestamp) - 1
+        if index < 0 or timestamp - self._timestamps[index] > tolerance:
+            return None
+        self._use(self._timestamps[index])
+        return self._transforms[index]
+
+    def lookup_buffer(self, buf):
+        """
+        Returns the transform of the frame buf, or of the one it replaces if
+        its timestamp moved by less than a frame duration, or None.
+        """
+        if buf.timestamp == gst.CLOCK_TIME_NONE:
+            return None
+        tolerance = 0
+        if buf.duration != gst.CLOCK_TIME_NONE:
+            tolerance = buf.duration - 1
+        return self.lookup(buf.timestamp, tolerance)
+
+    def load(self):
+        with open(self.path, 'rb') as cache_file:
+            self._timestamps, self._transforms = cPickle.load(cache_file)
+        self._recent = OrderedDict()
+        for timestamp in self._timestamps:
+            self._use(timestamp)
+        self._trim()
+
+    def _use(self, timestamp):
+        if not self.max_size:
+            return
+        self._recent.pop(timestamp, None)
+        self._recent[timestamp] = None
+
+    def _trim(self):
+        if not self.max_size:
+            return
+        if len(self._timestamps) <= self.max_size * (1 + self.TRIM_SLACK):
+            return
+        dropped = set()
+        while len(self._recent) > self.max_size:
+            timestamp, _ = self._recent.popitem(last=False)
+            dropped.add(timestamp)
+        kept = [index for index, timestamp in enumerate(self._timestamps)
+                      if timestamp not in dropped]
+        self._timestamps = [self._timestamps[index] for index in kept]
+        self._transforms = [self._transforms[index] for index in kept]
+
+    def save(self):
+        if not self.path:
+            return
+        with open(self.path, 'wb') as cache_file:
+            cPickle.dump((self._timestamps, self._transforms), cache_file,
+                         self.PICKLE_FORMAT)
+
+
+def create_transform_cache(element):
+    """
+    Returns a TransformCache configured from the transform-cache and
+    cache-size properties of element, or None if neither is set.
+    """
+    if not element.transform_cache and element.cache_size <= 0:
+        return None
+    return TransformCache(element.transform_cache or None,
+                          max(0, element.cache_size))
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Igalia S.L. and Guillaume Emont
+# Contact: Guilaume Emont <guijemont@igalia.com>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Offline search of the finder properties giving the best trade-off between
+speed and stability on a sample clip.
+
+Every configuration of a grid of properties is run on the frames of the clip
+with the finders of cv_flow_finder, accumulating transforms the way
+opticalflowrevert does. Each configuration gets two scores:
+ - cost: the time spent finding the flow and the transform of each frame
+ - residual: how much the stabilised frames still move, measured with a dense
+   optical flow between consecutive stabilised frames, in pixels
+The configurations that no other one beats on both scores are printed as
+properties for opticalflowfinder or opticalflowcorrector:
+
+  tools/parameter_sweep.py --output sweep.json clip.avi
+
+Configurations are run in parallel, which makes them compete for the CPU;
+use --jobs 1 for costs that are comparable with a real pipeline.
+"""
+
+import itertools
+import json
+import multiprocessing
+import optparse
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'python'))
+
+import cv_flow_finder
+from cv_flow_finder import transform_from_flow
+from cv_gst_util import cv2, numpy, gray_scale
+
+# Same defaults as the properties of opticalflowfinder
+DEFAULT_PROPERTIES = {
+    'algorithm': cv_flow_finder.LUCAS_KANADE,
+    'corner_count': 50,
+    'corner_quality_level': 0.1,
+    'corner_min_distance': 50,
+    'win_size': 30,
+    'pyramid_level': 4,
+    'max_iterations': 50,
+    'epsilon': 0.001,
+    'tile_rows': 1,
+    'tile_columns': 1,
+    'detection_threads': 0,
+    'motion_prior': 0,
+    'prior_downscale': 4,
+    'phase_downscale': 1,
+    'log_polar': False,
+    'guided_matching': False,
+    'search_radius': 30,
+}
+
+# Each grid maps property names to the values to try, all their combinations
+# are run
+DEFAULT_GRIDS = [
+    {'algorithm': [cv_flow_finder.LUCAS_KANADE],
+     'corner_count': [25, 50, 100],
+     'corner_min_distance': [20, 50],
+     'win_size': [10, 30],
+     'pyramid_level': [1, 4],
+     'max_iterations': [10, 50]},
+    {'algorithm': [cv_flow_finder.PHASE_CORRELATION],
+     'phase_downscale': [1, 2, 4],
+     'log_polar': [False, True]},
+]
+
+# grey level frames of the clip, loaded before the worker processes are forked
+_frames = []
+
+
+class Properties(object):
+    # stands for the element given to cv_flow_finder.create_finder()
+    def __init__(self, values, *args, **kw):
+        super(Properties, self).__init__(*args, **kw)
+        self.__dict__.update(DEFAULT_PROPERTIES)
+        self.__dict__.update(values)
+
+
+def load_frames(path, start=0, count=100):
+    """
+    Returns a list of the count grey level frames of the clip at path, from
+    frame number start.
+    """
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise IOError("Could not open %s" % path)
+    frames = []
+    index = 0
+    while len(frames) < count:
+        success, img = capture.read()
+        if not success:
+            break
+        if index >= start:
+            frames.append(gray_scale(img))
+        index += 1
+    return frames
+
+
+def expand_grids(grids):
+    """
+    Returns the list of property dictionaries given by all the combinations
+    of values in each grid.
+    """
+    configurations = []
+    for grid in grids:
+        names = sorted(grid)
+        for values in itertools.product(*[grid[name] for name in names]):
+            configuration = dict(itertools.izip(names, values))
+            if configuration not in configurations:
+                configurations.append(configuration)
+    return configurations
+
+
+def _warp(img, transform):
+    return cv2.warpPerspective(img,
+                               numpy.asarray(transform, dtype=numpy.float64),
+                               (img.shape[1], img.shape[0]),
+                               flags=cv2.WARP_INVERSE_MAP + cv2.INTER_LINEAR)
+
+
+def residual_motion(frames, transforms):
+    """
+    Returns the mean magnitude (in pixels) of the dense optical flow between
+    each pair of consecutive frames, once transformed with transforms, over
+    the area covered by both of them.
+    """
+    residuals = []
+    full = numpy.ones(frames[0].shape, dtype=numpy.uint8)
+    previous_img, previous_mask = None, None
+    for img, transform in itertools.izip(frames, transforms):
+        img = _warp(img, transform)
+        mask = _warp(full, transform)
+        if previous_img is not None:
+            # flow given by keyword, its position changed in OpenCV 3
+            flow = cv2.calcOpticalFlowFarneback(previous_img, img, flow=None,
+                                                pyr_scale=.5, levels=3,
+                                                winsize=15, iterations=3,
+                                                poly_n=5, poly_sigma=1.2,
+                                                flags=0)
+            valid = (mask > 0) & (previous_mask > 0)
+            if valid.any():
+                magnitudes = numpy.sqrt((flow[valid] ** 2).sum(axis=-1))
+                residuals.append(float(magnitudes.mean()))
+        previous_img, previous_mask = img, mask
+    return residuals
+
+
+def evaluate(configuration):
+    """
+    Runs the finder configured with the configuration dictionary over the
+    frames, and returns a dictionary of scores.
+    """
+    properties = Properties(configuration)
+    result = {'properties': configuration}
+    try:
+        finder = cv_flow_finder.create_finder(properties.algorithm, properties)
+    except Exception, e:
+        result['error'] = str(e)
+        return result
+
+    reference_transform = numpy.eye(3, dtype=numpy.float128)
+    transforms = [reference_transform]
+    costs = []
+    failures = 0
+    blob = None
+    for img0, img1 in itertools.izip(_frames, _frames[1:]):
+        start = time.time()
+        try:
+            flow, blob = finder.optical_flow_img(img0, img1, blob)
+            transform, inliers = transform_from_flow(flow)
+            blob = finder.drop_outliers(blob, inliers)
+        except cv2.error:
+            # like in the elements, we keep the last transform
+            transform = None
+            blob = None
+        costs.append(time.time() - start)
+
+        if transform is None:
+            failures += 1
+        else:
+            reference_transform = transform.dot(reference_transform)
+        transforms.append(reference_transform)
+    finder.close()
+
+    residuals = residual_motion(_frames, transforms)
+    costs.sort()
+    result.update({
+        'cost_ms': 1000. * sum(costs) / len(costs),
+        'cost_p95_ms': 1000. * costs[min(len(costs) - 1,
+                                         int(.95 * len(costs)))],
+        'residual': sum(residuals) / len(residuals) if residuals else None,
+        'failures': failures,
+    })
+    return result
+
+
+def pareto_front(results):
+    """
+    Returns the results that no other result beats on both cost and residual,
+    from the cheapest to the most expensive.
+    """
+    scored = [r for r in results if r.get('residual') is not None]
+    front = []
+    for result in sorted(scored, key=lambda r: (r['cost_ms'], r['residual'])):
+        if not front or result['residual'] < front[-1]['residual']:
+            front.append(result)
+    return front
+
+
+def launch_properties(properties):
+    # as given to gst-launch, only those that differ from the defaults
+    return ' '.join('%s=%s' % (name.replace('_', '-'), value)
+                    for name, value in sorted(properties.iteritems())
+                    if value != DEFAULT_PROPERTIES.get(name))
+
+
+def main():
+    global _frames
+
+    parser = optparse.OptionParser(usage="%prog [options] CLIP")
+    parser.add_option('--start', type='int', default=0,
+                      help="number of the first frame of the clip to use")
+    parser.add_option('--frames', type='int', default=100,
+                      help="number of frames of the clip to use")
+    parser.add_option('--grid',
+                      help="JSON list of objects mapping property names to "
+                           "lists of values to try, instead of the default "
+                           "grids")
+    parser.add_option('--jobs', type='int', default=0,
+                      help="number of configurations run in parallel, one "
+                           "per CPU if 0")
+    parser.add_option('--output', help="where to write the JSON report")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("expected the path of a clip")
+
+    grids = DEFAULT_GRIDS
+    if options.grid:
+        grids = json.loads(options.grid)
+        if isinstance(grids, dict):
+            grids = [grids]
+        for grid in grids:
+            # as enforced by the search-radius property of the elements
+            if any(radius < 1 for radius in grid.get('search_radius', [])):
+                parser.error("search_radius values must be at least 1")
+
+    _frames = load_frames(args[0], options.start, options.frames)
+    if len(_frames) < 2:
+        print >>sys.stderr, "Not enough frames in %s" % args[0]
+        return 1
+
+    configurations = expand_grids(grids)
+    print >>sys.stderr, "%d configurations on %d frames" % (len(configurations),
+                                                            len(_frames))
+
+    identity = [numpy.eye(3)] * len(_frames)
+    unstabilised = residual_motion(_frames, identity)
+    unstabilised = sum(unstabilised) / len(unstabilised)
+
+    pool = multiprocessing.Pool(options.jobs or None)
+    try:
+        results = pool.map(evaluate, configurations)
+    finally:
+        pool.close()
+        pool.join()
+
+    for result in results:
+        if 'error' in result:
+            print >>sys.stderr, "%s: %s" % (launch_properties(result['properties']),
+                                            result['error'])
+
+    front = pareto_front(results)
+    for result in front:
+        result['launch'] = launch_properties(result['properties'])
+
+    print >>sys.stderr, "residual motion without stabilisation: %.3f px" \
+        % unstabilised
+    for result in front:
+        print >>sys.stderr, "%.2f ms/frame, %.3f px residual, %d failures: %s" \
+            % (result['cost_ms'], result['residual'], result['failures'],
+               result['launch'] or '(defaults)')
+
+    report = {'clip': args[0], 'frames': len(_frames),
+              'unstabilised_residual': unstabilised,
+              'results': results, 'pareto': front}
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        print json.dumps(report, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Igalia S.L. and Guillaume Emont
+# Contact: Guilaume Emont <guijemont@igalia.com>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Throughput and latency benchmark of the stabilisation pipelines.
+
+Each pipeline topology is built around an appsrc pushing synthetic shaky
+frames and a fakesink that does not sync on the clock. Every (topology,
+resolution) pair runs in its own process so that peak RSS and CPU time are
+not mixed up between runs. The results are written as JSON, and can be
+compared with a previously saved report:
+
+  tools/pipeline_benchmark.py --output new.json --baseline old.json
+
+The exit status is 1 if a regression bigger than --tolerance was found.
+"""
+
+import itertools
+import json
+import optparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Each topology is a gst-launch style description, where the synthetic source
+# and the sink are named "src" and "sink", and the elements for which we
+# measure the latency are listed with their sink and source pads.
+TOPOLOGIES = {
+    'revert': ("appsrc name=src ! tee name=tee "
+               "tee. ! queue ! ffmpegcolorspace ! opticalflowfinder name=finder "
+               "! opticalflowrevert name=mux "
+               "tee. ! queue ! ffmpegcolorspace ! mux.mainsink "
+               "mux. ! fakesink name=sink sync=false",
+               [('finder', 'sink', 'source'), ('mux', 'mainsink', 'src')]),
+    'drawer': ("appsrc name=src ! tee name=tee "
+               "tee. ! queue ! ffmpegcolorspace ! opticalflowfinder name=finder "
+               "! opticalflowdrawer name=mux "
+               "tee. ! queue ! ffmpegcolorspace ! mux.mainsink "
+               "mux. ! fakesink name=sink sync=false",
+               [('finder', 'sink', 'source'), ('mux', 'mainsink', 'src')]),
+    'corrector': ("appsrc name=src ! ffmpegcolorspace "
+                  "! opticalflowcorrector name=corrector "
+                  "! fakesink name=sink sync=false",
+                  [('corrector', 'sink', 'src')]),
+}
+
+DEFAULT_RESOLUTIONS = ['320x240', '640x480', '1280x720']
+
+# metric: whether bigger is better
+METRICS = {
+    'fps': True,
+    'cpu_time': False,
+    'peak_rss_growth_kb': False,
+}
+
+FRAMERATE = 25
+
+# number of different synthetic frames, pushed in a loop
+FRAME_SET_SIZE = 10
+
+
+def shaky_frames(width, height, count, max_shift=8., max_angle=1., seed=0):
+    """
+    Returns a list of count RGB frames showing the same random texture, each
+    randomly moved by up to max_shift pixels and rotated by up to max_angle
+    degrees.
+    """
+    import cv2
+    import numpy
+
+    random = numpy.random.RandomState(seed)
+    margin = int(max_shift) * 2
+    texture = random.randint(0, 256, ((height + margin * 2) / 8,
+                                      (width + margin * 2) / 8, 3))
+    texture = cv2.resize(numpy.uint8(texture),
+                         (width + margin * 2, height + margin * 2),
+                         interpolation=cv2.INTER_CUBIC)
+    center = (width / 2. + margin, height / 2. + margin)
+
+    frames = []
+    for _ in xrange(count):
+        angle = random.uniform(-max_angle, max_angle)
+        transform = cv2.getRotationMatrix2D(center, angle, 1.)
+        transform[:, 2] += random.uniform(-max_shift, max_shift, 2) - margin
+        frames.append(cv2.warpAffine(texture, transform, (width, height)))
+    return frames
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_one(topology, width, height, frame_count, properties):
+    """
+    Runs the given topology on frame_count synthetic frames, in the current
+    process, and returns a dictionary of measurements.
+    """
+    os.environ['GST_PLUGIN_PATH'] = os.pathsep.join(
+            filter(None, [ROOT_DIR, os.environ.get('GST_PLUGIN_PATH')]))
+    import gst
+
+    description, measured = TOPOLOGIES[topology]
+    # a small set pushed in a loop, so that memory used by the frames does
+    # not grow with frame_count
+    frames = shaky_frames(width, height, min(frame_count, FRAME_SET_SIZE))
+
+    pipeline = gst.parse_launch(description)
+    for element_name, values in properties.iteritems():
+        element = pipeline.get_by_name(element_name)
+        for name, value in values.iteritems():
+            element.set_property(name, value)
+
+    src = pipeline.get_by_name('src')
+    src.props.caps = gst.Caps('video/x-raw-rgb,bpp=24,depth=24,'
+                              'endianness=4321,red_mask=16711680,'
+                              'green_mask=65280,blue_mask=255,'
+                              'width=%d,height=%d,framerate=%d/1'
+                              % (width, height, FRAMERATE))
+    src.props.format = gst.FORMAT_TIME
+    src.props.block = True
+    src.props.max_bytes = width * height * 3 * 4
+
+    # per element processing latency: time between a buffer entering the
+    # element and a buffer with the same timestamp leaving it
+    entered = {}
+    latencies = dict((name, []) for name, _, _ in measured)
+
+    def on_enter(pad, buf, name):
+        entered[(name, buf.timestamp)] = time.time()
+        return True
+
+    def on_leave(pad, buf, name):
+        start = entered.pop((name, buf.timestamp), None)
+        if start is not None:
+            latencies[name].append(time.time() - start)
+        return True
+
+    for name, sink_name, src_name in measured:
+        element = pipeline.get_by_name(name)
+        element.get_pad(sink_name).add_buffer_probe(on_enter, name)
+        element.get_pad(src_name).add_buffer_probe(on_leave, name)
+
+    output_times = []
+    def on_output(pad, buf):
+        output_times.append(time.time())
+        return True
+    pipeline.get_by_name('sink').get_pad('sink').add_buffer_probe(on_output)
+
+    # the peak RSS is reported relative to what we use before the pipeline
+    # starts, imports and synthetic frames included
+    cpu_before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    pipeline.set_state(gst.STATE_PLAYING)
+
+    duration = gst.SECOND / FRAMERATE
+    for i, frame in enumerate(itertools.islice(itertools.cycle(frames),
+                                               frame_count)):
+        buf = gst.Buffer(frame.tostring())
+        buf.timestamp = i * duration
+        buf.duration = duration
+        src.emit('push-buffer', buf)
+    src.emit('end-of-stream')
+
+    bus = pipeline.get_bus()
+    message = bus.timed_pop_filtered(gst.CLOCK_TIME_NONE,
+                                     gst.MESSAGE_EOS | gst.MESSAGE_ERROR)
+    wall_time = time.time() - start
+    pipeline.set_state(gst.STATE_NULL)
+    cpu_after = resource.getrusage(resource.RUSAGE_SELF)
+
+    if message.type == gst.MESSAGE_ERROR:
+        error, debug = message.parse_error()
+        raise RuntimeError("%s (%s)" % (error.message, debug))
+
+    # sustained rate: from the first output frame to the last one, so that
+    # start up costs are not taken into account
+    if len(output_times) > 1:
+        fps = (len(output_times) - 1) / (output_times[-1] - output_times[0])
+    else:
+        fps = None
+
+    result = {
+        'topology': topology,
+        'resolution': '%dx%d' % (width, height),
+        'frames': len(output_times),
+        'wall_time': wall_time,
+        'fps': fps,
+        'cpu_time': (cpu_after.ru_utime + cpu_after.ru_stime)
+                    - (cpu_before.ru_utime + cpu_before.ru_stime),
+        'peak_rss_growth_kb': cpu_after.ru_maxrss - cpu_before.ru_maxrss,
+        'baseline_rss_kb': cpu_before.ru_maxrss,
+        'latency': {},
+    }
+    for name, values in latencies.iteritems():
+        result['latency'][name] = {
+            'mean': sum(values) / len(values) if values else None,
+            'p50': _percentile(values, .5),
+            'p95': _percentile(values, .95),
+            'max': max(values) if values else None,
+        }
+    return result
+
+
+def run_isolated(topology, resolution, frame_count, properties):
+    # runs run_one in a child process, so that rusage is only about that run
+    command = [sys.executable, os.path.abspath(__file__),
+               '--child', '--topologies', topology,
+               '--resolutions', resolution,
+               '--frames', str(frame_count),
+               '--properties', json.dumps(properties)]
+    child = subprocess.Popen(command, stdout=subprocess.PIPE)
+    output, _ = child.communicate()
+    if child.returncode != 0:
+        return {'topology': topology, 'resolution': resolution,
+                'error': 'exited with status %d' % child.returncode}
+    # the elements print a lot, the result is the last line
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the list of regressions of results compared to baseline, as
+    human readable strings.
+    """
+    reference = dict(((r['topology'], r['resolution']), r)
+                     for r in baseline['results'])
+    regressions = []
+    for result in results['results']:
+        old = reference.get((result['topology'], result['resolution']))
+        if old is None or 'error' in old:
+            continue
+        if 'error' in result:
+            regressions.append("%s %s: %s" % (result['topology'],
+                                              result['resolution'],
+                                              result['error']))
+            continue
+
+        checks = [(metric, result[metric], old.get(metric), bigger_is_better)
+                  for metric, bigger_is_better in METRICS.iteritems()]
+        for name, latency in result['latency'].iteritems():
+            old_latency = old['latency'].get(name, {})
+            checks.append(('%s p95 latency' % name, latency['p95'],
+                           old_latency.get('p95'), False))
+
+        for metric, new_value, old_value, bigger_is_better in checks:
+            if new_value is None or not old_value:
+                continue
+            change = (new_value - old_value) / float(old_value)
+            if bigger_is_better:
+                change = -change
+            if change > tolerance:
+                regressions.append("%s %s: %s went from %.4g to %.4g"
+                                   % (result['topology'],
+                                      result['resolution'], metric,
+                                      old_value, new_value))
+    return regressions
+
+
+def _parse_resolution(resolution):
+    width, height = resolution.split('x')
+    return int(width), int(height)
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('--topologies', default=','.join(sorted(TOPOLOGIES)),
+                      help="comma separated list of topologies, among: %s"
+                           % ', '.join(sorted(TOPOLOGIES)))
+    parser.add_option('--resolutions', default=','.join(DEFAULT_RESOLUTIONS),
+                      help="comma separated list of WIDTHxHEIGHT")
+    parser.add_option('--frames', type='int', default=100,
+                      help="number of frames per run")
+    parser.add_option('--properties', default='{}',
+                      help="JSON object mapping element names (finder, mux, "
+                           "corrector) to the properties to set on them")
+    parser.add_option('--output', help="where to write the JSON report")
+    parser.add_option('--baseline', help="JSON report to compare against")
+    parser.add_option('--tolerance', type='float', default=.1,
+                      help="relative change considered a regression")
+    parser.add_option('--child', action='store_true', help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    topologies = options.topologies.split(',')
+    resolutions = options.resolutions.split(',')
+    properties = json.loads(options.properties)
+
+    if options.child:
+        width, height = _parse_resolution(resolutions[0])
+        result = run_one(topologies[0], width, height, options.frames,
+                         properties)
+        sys.stdout.write('\n' + json.dumps(result) + '\n')
+        return 0
+
+    results = []
+    for topology in topologies:
+        for resolution in resolutions:
+            result = run_isolated(topology, resolution, options.frames,
+                                  properties)
+            if 'error' in result:
+                print >>sys.stderr, "%s %s: %s" % (topology, resolution,
+                                                   result['error'])
+            else:
+                print >>sys.stderr, "%s %s: %.1f fps, %.2fs CPU, +%d KiB peak RSS" \
+                    % (topology, resolution, result['fps'] or 0.,
+                       result['cpu_time'], result['peak_rss_growth_kb'])
+            results.append(result)
+
+    report = {'frames': options.frames, 'properties': properties,
+              'results': results}
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        print json.dumps(report, indent=2, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(report, baseline, options.tolerance)
+        for regression in regressions:
+            print >>sys.stderr, "REGRESSION:", regression
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())